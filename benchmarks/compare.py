@@ -0,0 +1,41 @@
+"""2回分のベンチマークの結果（JSON）を比べる
+
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+METRICS = ('throughput', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def compare(before: dict, after: dict) -> list:
+    """シナリオ・指標ごとに (シナリオ, 指標, 前, 後, 変化率%) を返す"""
+    rows = []
+    for name in before['results'].keys() & after['results'].keys():
+        for metric in METRICS:
+            old = before['results'][name][metric]
+            new = after['results'][name][metric]
+            change = (new - old) / old * 100 if old else None
+            rows.append((name, metric, old, new, change))
+    return sorted(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{'scenario':<22}{'metric':<12}{'before':>10}{'after':>10}{'change':>10}")
+    for name, metric, old, new, change in compare(before, after):
+        change = '' if change is None else f'{change:+.1f}%'
+        print(f'{name:<22}{metric:<12}{old:>10.2f}{new:>10.2f}{change:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""レスポンスの圧縮のベンチマーク
+
+合成データベースに対して、圧縮なし・gzipの各レベル・brotli（入っていれば）でページを取得し、
+送るバイト数とリクエストあたりのCPU時間を比べてJSONに保存する。
+ページのキャッシュは有効のままにするので、CPU時間の差はほぼ圧縮にかかった分になる。
+
+    python -m benchmarks.compression --posts 1000 --out compression.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from flaskr import create_app
+from flaskr.compress import brotli
+
+from benchmarks.dataset import build_database, make_config
+from benchmarks.endpoints import summarize
+
+
+# 取得するページ
+PATHS = {
+    'index': '/',
+    'search_q': '/search?q=flask+sqlite',
+    'article': '/1',
+    'comments_json': '/1/comments',
+}
+
+
+def make_modes() -> dict:
+    """圧縮の設定の名前 -> (Accept-Encoding, 設定)"""
+    modes = {'identity': (None, {})}
+    for level in (1, 6, 9):
+        modes[f'gzip-{level}'] = ('gzip', {'COMPRESS_LEVEL': level})
+    if brotli is not None:
+        for quality in (4, 11):
+            modes[f'br-{quality}'] = ('br', {'COMPRESS_BROTLI_QUALITY': quality})
+    return modes
+
+
+def run_mode(db_path: str, accept_encoding, config: dict, requests: int, warmup: int) -> dict:
+    app = create_app(make_config(db_path, **config))
+    client = app.test_client()
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+
+    results = {}
+    for name, path in PATHS.items():
+        for _ in range(warmup):
+            client.get(path, headers=headers).get_data()
+
+        durations, cpu = [], 0.0
+        for _ in range(requests):
+            begin, begin_cpu = time.perf_counter(), time.process_time()
+            res = client.get(path, headers=headers)
+            body = res.get_data()
+            durations.append(time.perf_counter() - begin)
+            cpu += time.process_time() - begin_cpu
+
+        results[name] = {
+            **summarize(durations),
+            'bytes': len(body),
+            'encoding': res.content_encoding,
+            'cpu_ms': cpu / requests * 1000,
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=200, help='requests per page and mode')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='flaskr-compression-')
+    try:
+        db_path = os.path.join(workdir, 'flaskr.sqlite')
+        build_database(db_path, args.posts)
+        results = {
+            mode: run_mode(db_path, accept_encoding, config, args.requests, args.warmup)
+            for mode, (accept_encoding, config) in make_modes().items()
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # 圧縮なしと比べて減ったバイト数と増えたCPU時間
+    for mode, pages in results.items():
+        for name, result in pages.items():
+            identity = results['identity'][name]
+            result['saved_bytes'] = identity['bytes'] - result['bytes']
+            result['ratio'] = result['bytes'] / identity['bytes']
+            result['extra_cpu_ms'] = result['cpu_ms'] - identity['cpu_ms']
+
+    report = {
+        'meta': {
+            'posts': args.posts,
+            'requests': args.requests,
+            'brotli': brotli is not None,
+            'python': platform.python_version(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+
+    print(f"{'page':<15}{'mode':<10}{'bytes':>9}{'ratio':>8}{'saved':>9}"
+          f"{'cpu ms':>9}{'+cpu ms':>9}{'p50 ms':>9}")
+    for name in PATHS:
+        for mode, pages in results.items():
+            result = pages[name]
+            print(f"{name:<15}{mode:<10}{result['bytes']:>9}{result['ratio']:>8.2f}"
+                  f"{result['saved_bytes']:>9}{result['cpu_ms']:>9.3f}"
+                  f"{result['extra_cpu_ms']:>9.3f}{result['p50_ms']:>9.3f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""ベンチマーク用の合成データベースを作る
+
+投稿数を指定すると、ユーザー・コメント・投票をそれに比例した数だけ作る。
+同じ引数なら同じ内容になるよう乱数のシードを固定する。中身は flask seed と同じ。
+"""
+import os
+
+import flaskr.seed
+from flaskr import create_app
+from flaskr.db import init_db
+
+
+# ベンチマークのユーザーのパスワード（ハッシュは計算を軽くするため低いコストで作る）
+PASSWORD = 'password'
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+
+def make_config(db_path: str, **config) -> dict:
+    """ベンチマーク用のアプリケーションの設定"""
+    return {'TESTING': True, 'DATABASE': db_path, **config}
+
+
+def build_database(db_path: str, posts: int, comments_per_post: int = 3,
+                   votes_per_post: int = 5, seed: int = 0) -> dict:
+    """posts件の投稿を持つデータベースを db_path に作り、作った件数を返す"""
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+
+    users = max(10, posts // 10, votes_per_post)
+    app = create_app(make_config(db_path, PASSWORD_HASH_METHOD=PASSWORD_HASH_METHOD))
+
+    with app.app_context():
+        init_db()
+        for _ in flaskr.seed.seed(users, posts, comments_per_post, votes_per_post, seed,
+                                  password=PASSWORD):
+            pass
+
+    return {
+        'users': users,
+        'posts': posts,
+        'comments': posts * comments_per_post,
+        'votes': posts * votes_per_post,
+    }
@@ -0,0 +1,185 @@
+"""エンドポイントのベンチマーク
+
+合成データベースに対してFlaskのテストクライアントで各エンドポイントを繰り返し呼び、
+スループットとレイテンシのパーセンタイル（p50/p95/p99）をJSONに保存する。
+サーバーもネットワークも使わないのでオフラインで動く。
+
+    python -m benchmarks.endpoints --posts 10000 --out before.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flaskr import create_app
+
+from benchmarks.dataset import PASSWORD, build_database, make_config
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """ソート済みの値のpパーセンタイル（nearest-rank）"""
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(durations: list) -> dict:
+    """1回ごとの処理時間（秒）からスループットとパーセンタイル（ミリ秒）を求める"""
+    values = sorted(durations)
+    total = sum(values)
+    return {
+        'requests': len(values),
+        'throughput': len(values) / total if total else None,
+        'mean_ms': total / len(values) * 1000,
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+def make_scenarios(posts: int) -> dict:
+    """シナリオ名 -> (ログインが必要か, 1回分のリクエストを送る関数)"""
+    start = datetime(2020, 1, 1)
+    deep = posts // 2
+    deep_cursor = f'{start + timedelta(seconds=deep * 60)}_{deep}'
+
+    def get(path):
+        def run(client, i):
+            return client.get(path)
+        return run
+
+    def article(client, i):
+        return client.get(f'/{i % posts + 1}')
+
+    def article_not_modified(client, i):
+        # 最初の1回で得たETagで条件付きGETを送る
+        res = client.get('/1', headers={'If-None-Match': client.etag})
+        return res
+
+    def comment(client, i):
+        return client.post(f'/{i % posts + 1}/comment/create', data={'body': 'benchmark'})
+
+    def vote(client, i):
+        return client.post(f'/{i % posts + 1}/vote', data={'intention': str(i % 2)})
+
+    def create(client, i):
+        return client.post('/create', data={'title': 'benchmark', 'body': '# benchmark\n\nbody'})
+
+    return {
+        'index': (False, get('/')),
+        'index_deep': (False, get(f'/?before={deep_cursor}')),
+        'search_q': (False, get('/search?q=flask+sqlite')),
+        # ほとんどの投稿に一致する語（順位を付ける件数の上限が効く）
+        'search_broad': (False, get('/search?q=flask')),
+        'search_broad_deep': (False, get('/search?q=flask&page=50')),
+        'search_author': (False, get('/search?author=user1')),
+        'article': (False, article),
+        'article_logged_in': (True, article),
+        'article_not_modified': (False, article_not_modified),
+        'comment_create': (True, comment),
+        'vote': (True, vote),
+        'create_post': (True, create),
+    }
+
+
+def run_benchmark(db_path: str, posts: int, requests: int, warmup: int,
+                  scenarios: list = None, config: dict = None) -> dict:
+    """各シナリオを requests 回ずつ実行して結果を返す"""
+    results = {}
+    for name, (login, run) in make_scenarios(posts).items():
+        if scenarios and name not in scenarios:
+            continue
+
+        # シナリオごとにアプリケーションを作り、キャッシュなどの状態を持ち越さない
+        app = create_app(make_config(db_path, **(config or {})))
+        client = app.test_client()
+        if login:
+            client.post('/auth/login', data={'username': 'user1', 'password': PASSWORD})
+        client.etag = client.get('/1').headers.get('ETag', '')
+
+        # ストリーミングのレスポンスは本文を最後まで読まないと描画中のコンテキストが残るので、必ず読む
+        for i in range(warmup):
+            run(client, i).get_data()
+
+        durations = []
+        statuses = {}
+        for i in range(requests):
+            begin = time.perf_counter()
+            res = run(client, i)
+            res.get_data()
+            durations.append(time.perf_counter() - begin)
+            statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+        results[name] = {**summarize(durations), 'status': statuses}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--posts', type=int, default=1000,
+                        help='number of posts in the dataset (10^3 - 10^6)')
+    parser.add_argument('--comments-per-post', type=int, default=3)
+    parser.add_argument('--votes-per-post', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='warm-up requests per scenario')
+    parser.add_argument('--scenario', action='append', help='run only these scenarios')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='keep the anonymous page cache enabled')
+    parser.add_argument('--db', help='dataset path (reused if it exists, built otherwise)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    db_path = args.db or os.path.join(tempfile.gettempdir(), f'flaskr-bench-{args.posts}.sqlite')
+    if not os.path.exists(db_path):
+        begin = time.perf_counter()
+        counts = build_database(db_path, args.posts, args.comments_per_post,
+                                args.votes_per_post, args.seed)
+        print(f'Built {db_path} {counts} in {time.perf_counter() - begin:.1f}s')
+
+    # 書き込みのシナリオでデータが変わらないよう、作業用のコピーに対して実行する
+    work_path = db_path + '.work'
+    with sqlite3.connect(db_path) as src, sqlite3.connect(work_path) as dst:
+        src.backup(dst)
+
+    config = {} if args.response_cache else {'RESPONSE_CACHE_BACKEND': 'null'}
+    try:
+        results = run_benchmark(work_path, args.posts, args.requests, args.warmup,
+                                args.scenario, config)
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(work_path + suffix):
+                os.unlink(work_path + suffix)
+
+    report = {
+        'meta': {
+            'posts': args.posts,
+            'comments_per_post': args.comments_per_post,
+            'votes_per_post': args.votes_per_post,
+            'requests': args.requests,
+            'response_cache': args.response_cache,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'date': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+
+    print(f"{'scenario':<22}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<22}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""起動時間のベンチマーク
+
+新しいPythonのプロセスで flaskr の読み込み・create_app・最初のリクエストにかかる時間を測り、
+JSONに保存する。テンプレートのバイトコードのキャッシュがない（cold）・precompile済み（warm）・
+キャッシュを使わない（off）の3通りで、それぞれ --runs 回起動して中央値などを求める。
+
+    python -m benchmarks.startup --out startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from benchmarks.dataset import build_database, make_config
+from benchmarks.endpoints import summarize
+
+
+# 子プロセスで実行するコード（段階ごとの経過時間をJSONで標準出力に書く）
+CHILD = '''
+import json, sys, time
+begin = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+client = app.test_client()
+for path in json.loads(sys.argv[2]):
+    client.get(path).get_data()
+first = time.perf_counter()
+print(json.dumps({
+    'import': imported - begin,
+    'create_app': created - imported,
+    'first_requests': first - created,
+    'total': first - begin,
+    'modules': len(sys.modules),
+}))
+'''
+
+# 最初のリクエストとして送るパス（それぞれ別のテンプレートを使う）
+PATHS = ['/', '/1', '/search?q=flask', '/auth/login']
+
+
+def run_once(config: dict) -> dict:
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD, json.dumps(config), json.dumps(PATHS)],
+        check=True, capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def run_mode(db_path: str, cache_dir, runs: int, warm: bool) -> dict:
+    config = make_config(db_path, JINJA_BYTECODE_CACHE_DIR=cache_dir,
+                         RESPONSE_CACHE_BACKEND='null')
+    samples = []
+    for _ in range(runs):
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            if warm:
+                # 起動の前にprecompileコマンドを別のプロセスで実行しておく
+                _precompile(config)
+        samples.append(run_once(config))
+
+    return {
+        stage: summarize([sample[stage] for sample in samples])
+        for stage in ('import', 'create_app', 'first_requests', 'total')
+    } | {'modules': samples[-1]['modules']}
+
+
+def _precompile(config: dict):
+    code = ('import json, sys\n'
+            'from flaskr import create_app\n'
+            'app = create_app(json.loads(sys.argv[1]))\n'
+            'app.test_cli_runner().invoke(args=["precompile"])\n')
+    subprocess.run([sys.executable, '-c', code, json.dumps(config)], check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='process starts per mode')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='flaskr-startup-')
+    try:
+        db_path = os.path.join(workdir, 'flaskr.sqlite')
+        build_database(db_path, 100)
+        cache_dir = os.path.join(workdir, 'jinja_cache')
+        results = {
+            'cold': run_mode(db_path, cache_dir, args.runs, warm=False),
+            'warm': run_mode(db_path, cache_dir, args.runs, warm=True),
+            'off': run_mode(db_path, None, args.runs, warm=False),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'runs': args.runs,
+            'paths': PATHS,
+            'python': platform.python_version(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }
+
+    print(f"{'mode':<8}{'import ms':>12}{'create_app ms':>15}{'first req ms':>15}{'total ms':>12}")
+    for mode, result in results.items():
+        print(f"{mode:<8}{result['import']['p50_ms']:>12.1f}{result['create_app']['p50_ms']:>15.1f}"
+              f"{result['first_requests']['p50_ms']:>15.1f}{result['total']['p50_ms']:>12.1f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,5 @@
-import os, re
-from flask import Flask, Markup
-
-from markdown2 import markdown
+import os
+from flask import Flask
 
 
 # Flaskインスタンスを作成するファクトリ関数
@@ -12,6 +10,71 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        # データベース接続のプールの大きさ（0ならリクエストごとに接続を閉じる）
+        DATABASE_POOL_SIZE=5,
+        # 接続ごとにキャッシュするプリペアドステートメントの数
+        DATABASE_CACHED_STATEMENTS=256,
+        # 接続ごとに実行するPRAGMA
+        DATABASE_JOURNAL_MODE='WAL',
+        DATABASE_SYNCHRONOUS='NORMAL',
+        DATABASE_MMAP_SIZE=64 * 1024 * 1024,
+        DATABASE_CACHE_SIZE=-16000,  # 負の値はKiB単位
+        DATABASE_BUSY_TIMEOUT=5000,  # ミリ秒
+        # 外部キーを有効にし、投稿を削除したときにコメント・投票も消す（ON DELETE CASCADE）
+        DATABASE_FOREIGN_KEYS=True,
+        # ログインユーザーの情報のキャッシュの件数と有効期限（秒）
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=60,
+        # パスワードのハッシュの方式（コスト）と、計算するスレッド数・待ちの上限・待ち時間（秒）
+        PASSWORD_HASH_METHOD='pbkdf2:sha256:260000',
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_MAX_PENDING=16,
+        PASSWORD_HASH_TIMEOUT=5,
+        # ログイン・登録の試行回数の制限（IPアドレス・ユーザー名ごと）
+        AUTH_RATE_LIMIT_BURST=10,
+        AUTH_RATE_LIMIT_PER_MINUTE=10,
+        AUTH_RATE_LIMIT_SIZE=10000,
+        # ログインしていないユーザー向けのページのキャッシュ（'memory', 'null' か保存先を作る関数）
+        RESPONSE_CACHE_BACKEND='memory',
+        RESPONSE_CACHE_SIZE=512,
+        RESPONSE_CACHE_TTL=300,
+        # リクエストの最初にcache_generationの表を読み、他のプロセスでの書き込みで古くなったキャッシュを捨てる
+        # （プロセスが1つだけなら無効にしてもよい）
+        CACHE_GENERATION_CHECK=True,
+        # 一覧の1ページあたりの投稿数
+        POSTS_PER_PAGE=10,
+        # 全文検索でbm25の順位を付ける件数の上限（一致した中の新しいものから。これより先はページ送りしない）
+        SEARCH_RANK_LIMIT=1000,
+        # 記事の詳細ページ・コメントのJSONの1ページあたりのコメント数
+        COMMENTS_PER_PAGE=20,
+        # コンパイルしたテンプレートを保存するディレクトリ（Noneなら保存しない）
+        JINJA_BYTECODE_CACHE_DIR=os.path.join(app.instance_path, 'jinja_cache'),
+        # build-assetsで書き出したstaticのmanifest.jsonがあれば、url_forでハッシュつきの名前を使う
+        ASSETS_USE_MANIFEST=True,
+        # リクエストごとのSQLの件数・時間の計測（Server-Timingヘッダーとflaskr.sqlロガーに出す）
+        # 有効にした後に作った接続から計測する。文ごとの時間はリクエストあたりこの件数まで記録する
+        SQL_INSTRUMENTATION=False,
+        SQL_INSTRUMENTATION_MAX_STATEMENTS=20,
+        # この時間（ミリ秒）以上かかったSQLを実行計画とともに SLOW_QUERY_LOG に記録する（Noneなら記録しない）
+        # SLOW_QUERY_REDACT が真ならパラメータの値は型と長さだけを残す
+        SLOW_QUERY_THRESHOLD_MS=None,
+        SLOW_QUERY_LOG=os.path.join(app.instance_path, 'slow_queries.log'),
+        SLOW_QUERY_REDACT=True,
+        # /metrics（Prometheusのテキスト形式）でリクエスト数・エラー数・レスポンス時間とプール・キャッシュの統計を出す
+        # 有効にしたときも、METRICS_TOKEN を指定すれば「Authorization: Bearer <token>」のリクエストだけ、
+        # 指定しなければ同じマシン（127.0.0.1, ::1）からのリクエストだけに返す
+        # 複数のプロセスで動かすときは共有のディレクトリを METRICS_DIR に指定すると、
+        # 各プロセスが METRICS_FLUSH_INTERVAL 秒ごとに写しを書き出し、/metrics で合計する
+        METRICS_ENABLED=False,
+        METRICS_TOKEN=None,
+        METRICS_DIR=None,
+        METRICS_FLUSH_INTERVAL=1.0,
+        # Accept-Encodingに応じてレスポンスをgzip（brotliがあればbr）で圧縮する
+        # COMPRESS_MIN_SIZE バイト未満の本文は圧縮しない。COMPRESS_BROTLI_QUALITY がNoneならbrは使わない
+        COMPRESS_ENABLED=True,
+        COMPRESS_LEVEL=6,
+        COMPRESS_BROTLI_QUALITY=4,
+        COMPRESS_MIN_SIZE=500,
     )
     # 標準設定の上書き
     if test_config is None:
@@ -35,6 +98,26 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    # SQLの計測をアプリケーションに登録
+    from . import instrument
+    instrument.init_app(app)
+
+    # メトリクスの記録と/metricsをアプリケーションに登録
+    from . import metrics
+    metrics.init_app(app)
+
+    # 合成データの投入コマンドを登録
+    from . import seed
+    seed.init_app(app)
+
+    # データの書き出し・読み込みコマンドを登録
+    from . import transfer
+    transfer.init_app(app)
+
+    # ページのキャッシュをアプリケーションに登録
+    from . import cache
+    cache.init_app(app)
+
     # /authのブループリントをアプリケーションに登録
     from .routes import auth
     app.register_blueprint(auth.bp, url_prefix='/auth')
@@ -44,13 +127,16 @@ def create_app(test_config=None):
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
 
-    # テンプレートのカスタムフィルターを登録
-    @app.template_filter('markdown')
-    def markdown_filter(str):
-        return markdown(Markup.escape(str), extras=['tables'])
+    # staticのファイルの配信とビルドのコマンドを登録
+    from . import assets
+    assets.init_app(app)
+
+    # テンプレートのカスタムフィルターと本文の変換コマンドを登録
+    from . import render
+    render.init_app(app)
 
-    @app.template_filter('remove_tag')
-    def remove_tag_filter(str):
-        return re.sub('<.+?>', ' ', str)
+    # レスポンスの圧縮をアプリケーションに登録
+    from . import compress
+    compress.init_app(app)
 
     return app
@@ -0,0 +1,198 @@
+import base64
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:  # brotliがなければ .br は作らず、gzipだけにする
+    brotli = None
+
+
+# 自前で配信する外部のファイル（staticからのパス -> (取得元, SRIのハッシュ)）
+# build-assets --vendor で取得し、ハッシュで中身を確かめてからstaticに保存する
+# （テンプレートはグリッドに pure-u-1 しか使わないので、grids-responsive は読み込まない）
+VENDOR = {
+    'vendor/purecss/pure-min.css': (
+        'https://unpkg.com/purecss@2.1.0/build/pure-min.css',
+        'sha384-yHIFVG6ClnONEA5yB5DJXfW2/KC173DIQrYoZMEtBvGzmf0PKiGyNEqe9N6BNDBH',
+    ),
+}
+
+# ハッシュつきのファイルを書き出す static の中のディレクトリ
+BUILD_DIR = 'build'
+
+# 圧縮しても小さくならない種類のファイル
+COMPRESSED_TYPES = ('image/', 'video/', 'audio/', 'font/woff', 'application/zip', 'application/gzip')
+# そのうちテキストなので圧縮が効く種類
+COMPRESSIBLE_TYPES = ('image/svg+xml',)
+
+# 圧縮済みのファイルの拡張子
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# ハッシュつきのファイルのキャッシュの有効期限（1年）
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def is_compressed_type(mimetype: str) -> bool:
+    """圧縮しても小さくならない種類か"""
+    return mimetype.startswith(COMPRESSED_TYPES) and not mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def _integrity(data: bytes, algorithm: str) -> str:
+    return f'{algorithm}-' + base64.b64encode(hashlib.new(algorithm, data).digest()).decode()
+
+
+def vendor_assets(static_folder: str):
+    """VENDORのファイルを取得して static に保存し、保存したパスを返す"""
+    # urllib.requestはsslなども読み込むので、取得するときだけ読み込む
+    import urllib.request
+
+    for filename, (url, integrity) in VENDOR.items():
+        with urllib.request.urlopen(url, timeout=30) as f:
+            data = f.read()
+        algorithm = integrity.split('-', 1)[0]
+        if _integrity(data, algorithm) != integrity:
+            raise click.ClickException(f'{url} does not match {integrity}.')
+        path = os.path.join(static_folder, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        yield filename
+
+
+def _sources(static_folder: str):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and BUILD_DIR in dirs:
+            dirs.remove(BUILD_DIR)
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+
+
+def _compress(data: bytes):
+    """(圧縮の種類, 圧縮したデータ) を優先する順に返す　ビルド時に一度だけなので最大の圧縮率にする"""
+    if brotli is not None:
+        yield 'br', brotli.compress(data, quality=11)
+    yield 'gzip', gzip.compress(data, 9, mtime=0)
+
+
+def build_assets(static_folder: str) -> dict:
+    """static のファイルを、中身のハッシュを名前に入れて build に書き出す
+
+    圧縮が効く種類のファイルは .gz（と brotli があれば .br）も作る。
+    元の名前 -> ハッシュつきの名前と、ハッシュつきの名前 -> 用意した圧縮の一覧を manifest.json に書き、それを返す
+    """
+    build = os.path.join(static_folder, BUILD_DIR)
+    shutil.rmtree(build, ignore_errors=True)
+    manifest = {'files': {}, 'encodings': {}}
+
+    for filename in _sources(static_folder):
+        with open(os.path.join(static_folder, filename), 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(filename)
+        hashed = f'{BUILD_DIR}/{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        path = os.path.join(static_folder, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        manifest['files'][filename] = hashed
+
+        # 圧縮済みの種類のファイルも、ハッシュつきとして1年間キャッシュさせるため一覧には載せる
+        encodings = manifest['encodings'][hashed] = []
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if is_compressed_type(mimetype):
+            continue
+        for encoding, compressed in _compress(data):
+            # 小さくならなければ元のファイルを返せばよいので作らない
+            if len(compressed) < len(data):
+                with open(path + SUFFIXES[encoding], 'wb') as f:
+                    f.write(compressed)
+                encodings.append(encoding)
+
+    with open(os.path.join(build, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(app) -> dict:
+    """manifest.jsonと、staticに置いてある外部のファイルの一覧（描画のたびには調べない）"""
+    vendored = [filename for filename in VENDOR
+                if os.path.exists(os.path.join(app.static_folder, filename))]
+    path = os.path.join(app.static_folder, BUILD_DIR, 'manifest.json')
+    if not app.config['ASSETS_USE_MANIFEST'] or not os.path.exists(path):
+        return {'files': {}, 'encodings': {}, 'vendored': vendored}
+    with open(path) as f:
+        return {**json.load(f), 'vendored': vendored}
+
+
+# url_for('static', filename=...) の filename をハッシュつきの名前に置き換える
+def hashed_filename(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        files = current_app.extensions['flaskr_assets']['files']
+        values['filename'] = files.get(values['filename'], values['filename'])
+
+
+# staticのファイルを返す
+# ハッシュつきのファイルは中身が変わらないので1年間キャッシュさせ、
+# Accept-Encodingに合う圧縮済みのファイルがあればそれを返す（リクエストのたびには圧縮しない）
+def send_static(filename: str):
+    app = current_app._get_current_object()
+    encodings = app.extensions['flaskr_assets']['encodings'].get(filename)
+    if encodings is None:
+        return app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding in encodings:
+        if request.accept_encodings[encoding]:
+            response = send_from_directory(app.static_folder, filename + SUFFIXES[encoding],
+                                           mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(app.static_folder, filename, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# 自前で配信する外部のファイルのURLとSRIのハッシュ
+# staticに置いていなければ（build-assets --vendor の前）取得元のCDNを使う
+def vendor_asset(filename: str) -> dict:
+    url, integrity = VENDOR[filename]
+    if filename in current_app.extensions['flaskr_assets']['vendored']:
+        url = url_for('static', filename=filename)
+    return {'url': url, 'integrity': integrity}
+
+
+# staticのファイルをハッシュつきの名前と圧縮済みのファイルに書き出すカスタムコマンド
+@click.command('build-assets')
+@click.option('--vendor', is_flag=True, help='Download the vendored files first.')
+@with_appcontext
+def build_assets_command(vendor):
+    static_folder = current_app.static_folder
+    if vendor:
+        for filename in vendor_assets(static_folder):
+            click.echo(f'Downloaded {filename}.')
+    manifest = build_assets(static_folder)
+    current_app.extensions['flaskr_assets'] = load_manifest(current_app)
+    compressed = sum(len(encodings) for encodings in manifest['encodings'].values())
+    click.echo(f"Built {len(manifest['files'])} files and {compressed} compressed variants"
+               f' into {os.path.join(static_folder, BUILD_DIR)}.')
+    if brotli is None:
+        click.echo('brotli is not installed; only .gz variants were written.')
+
+
+def init_app(app):
+    app.extensions['flaskr_assets'] = load_manifest(app)
+    app.url_defaults(hashed_filename)
+    app.view_functions['static'] = send_static
+    app.add_template_global(vendor_asset)
+    app.cli.add_command(build_assets_command)
@@ -0,0 +1,311 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, make_response, request, session
+
+from flaskr.db import get_db
+
+
+# 件数の上限と有効期限つきのLRUキャッシュ
+# プロセス内のメモリに置き、複数のスレッドから使えるようにロックで守る
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float = None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# 何も保存しないキャッシュ（レスポンスのキャッシュを無効にするとき用）
+class NullCache:
+    hits = 0
+    misses = 0
+
+    def get(self, key, default=None):
+        return default
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+# キャッシュしたページ
+# タグごとの世代を保存時点のものとして持ち、世代が進んでいれば古いページとして扱う
+# ヘッダーはviewが返した時点（after_requestの前）のものを写す（Server-Timingなどはリクエストごとに付け直す）
+# ストリーミングのレスポンスは本文を送り出し終えてから body を入れる
+class CachedPage:
+    def __init__(self, response, versions):
+        self.status = response.status_code
+        self.headers = [(k, v) for k, v in response.headers.items() if k.lower() != 'set-cookie']
+        self.body = None if response.is_streamed else response.get_data()
+        self.etag, _ = response.get_etag()
+        self.versions = versions
+
+    def make_response(self):
+        return current_app.response_class(self.body, self.status, self.headers)
+
+
+# ログインしていないユーザー向けのページのキャッシュ
+# 保存先（backend）は get, set, delete, clear を持つオブジェクトなら何でもよい
+# 書き込みのたびにタグ（'list', 'post:<id>' など）の世代を進めて、関係するページを無効にする
+# 世代はタグのハッシュで決まる固定数の枠に持つので、投稿が増えてもメモリは増えない
+# （枠が重なったタグは余分に無効になるだけで、古いページを返すことはない）
+class ResponseCache:
+    TAG_SLOTS = 4096
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._versions = [0] * self.TAG_SLOTS
+        self._lock = threading.Lock()
+
+    def versions(self, tags):
+        return tuple((tag, self._versions[hash(tag) % self.TAG_SLOTS]) for tag in tags)
+
+    def get(self, key):
+        page = self.backend.get(key)
+        if page is None:
+            return None
+        if page.versions != self.versions(tag for tag, _ in page.versions):
+            self.backend.delete(key)
+            return None
+        return page
+
+    def set(self, key, page):
+        self.backend.set(key, page)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[hash(tag) % self.TAG_SLOTS] += 1
+
+    def clear(self):
+        self.backend.clear()
+
+
+# 設定に従ってレスポンスのキャッシュの保存先を作る
+# RESPONSE_CACHE_BACKEND は 'memory', 'null' か、appを受け取って保存先を返す関数
+def make_backend(app):
+    backend = app.config['RESPONSE_CACHE_BACKEND']
+    if backend == 'memory':
+        return LRUCache(app.config['RESPONSE_CACHE_SIZE'], ttl=app.config['RESPONSE_CACHE_TTL'])
+    if backend == 'null':
+        return NullCache()
+    return backend(app)
+
+
+# ログインしていないユーザーへのGETのレスポンスを、パスとクエリ文字列をキーにキャッシュするデコレータ
+# tagsはURLの変数で埋められる書式文字列（例: 'post:{id}'）
+def cached_page(*tags):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(*args, **kwargs):
+            # ログインしているときやflashのメッセージが残っているときはページが変わるのでキャッシュしない
+            if g.user is not None or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            check_generations()
+            cache = current_app.extensions['flaskr_response_cache']
+            key = request.full_path
+            page = cache.get(key)
+            if page is not None:
+                return not_modified(page.etag) or page.make_response()
+
+            versions = cache.versions([tag.format(**request.view_args) for tag in tags])
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not session.modified:
+                page = CachedPage(response, versions)
+                if response.is_streamed:
+                    # 送り出した本文を集めておき、最後まで送れたときだけ保存する
+                    response.response = _tee(response.response, response.charset,
+                                             lambda body: _store_streamed(cache, key, page, body))
+                else:
+                    cache.set(key, page)
+            return response
+
+        return wrapped_view
+
+    return decorator
+
+
+def _store_streamed(cache, key, page, body):
+    page.body = body
+    cache.set(key, page)
+
+
+def _tee(iterable, charset, store):
+    chunks = []
+    for chunk in iterable:
+        if isinstance(chunk, str):
+            chunk = chunk.encode(charset)
+        chunks.append(chunk)
+        yield chunk
+    store(b''.join(chunks))
+
+
+# ページの内容を表すETagを作る
+# 同じURLでもログインしているユーザーによって表示が変わるので、ユーザーのidも含める
+def make_etag(*parts):
+    user_id = g.user['id'] if g.user is not None else 0
+    key = ':'.join(str(part) for part in (*parts, user_id))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+# If-None-MatchがETagと一致すれば304のレスポンスを返す（一致しなければNone）
+# flashのメッセージが残っているときは表示が変わるので304にしない
+def not_modified(etag):
+    if (etag is None or request.method != 'GET' or '_flashes' in session
+            or not request.if_none_match.contains(etag)):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.vary.add('Cookie')
+    return response
+
+
+# レスポンスにETagとLast-Modifiedを付け、毎回問い合わせて確認するよう指示する
+def set_validators(response, etag, last_modified=None):
+    if request.method == 'GET':
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    return response
+
+
+# 他のプロセスでの書き込みを知るための、最後に読んだ世代
+class Generations:
+    def __init__(self):
+        self.seen = None
+        self._lock = threading.Lock()
+
+    def changed(self, db):
+        """前回読んだ後に世代が進んだ名前空間"""
+        if self.seen is None:
+            # 起動した直後はキャッシュが空なので、今の世代を覚えるだけでよい
+            latest = db.execute(
+                'SELECT coalesce(max(generation), 0) FROM cache_generation').fetchone()[0]
+            with self._lock:
+                if self.seen is None:
+                    self.seen = latest
+            return []
+
+        rows = db.execute(
+            'SELECT namespace, generation FROM cache_generation WHERE generation > ?',
+            (self.seen,)
+        ).fetchall()
+        if rows:
+            with self._lock:
+                self.seen = max(self.seen, *(generation for _, generation in rows))
+        return [namespace for namespace, _ in rows]
+
+
+# 名前空間（'list', 'post:<id>', 'user:<id>'）の世代をデータベースで進める
+# 書き込みのトランザクションの中で呼べば、書き込みと一緒にコミットされる
+# （トランザクションの外で呼んだときはすぐにコミットする）
+def bump_generations(*namespaces):
+    db = get_db()
+    in_transaction = db.in_transaction
+    db.executemany(
+        'INSERT INTO cache_generation (namespace, generation)'
+        ' VALUES (?, (SELECT coalesce(max(generation), 0) + 1 FROM cache_generation))'
+        ' ON CONFLICT (namespace) DO UPDATE SET generation = excluded.generation',
+        [(namespace,) for namespace in namespaces]
+    )
+    if not in_transaction:
+        db.commit()
+
+
+# 他のプロセス（と自分）が進めた名前空間のキャッシュだけを捨てる
+# キャッシュを使うリクエストで最初に使う前に1回だけ呼ぶ（キャッシュを使わないリクエストではデータベースを読まない）
+# 進んだ名前空間がなければ、索引で0行を読むだけで終わる
+def check_generations():
+    app = current_app._get_current_object()
+    if 'generations_checked' in g or not app.config['CACHE_GENERATION_CHECK']:
+        return
+    g.generations_checked = True
+    for namespace in app.extensions['flaskr_cache_generations'].changed(get_db()):
+        kind, _, key = namespace.partition(':')
+        if kind == 'user':
+            if 'flaskr_user_cache' in app.extensions:
+                app.extensions['flaskr_user_cache'].delete(int(key))
+        else:
+            app.extensions['flaskr_response_cache'].invalidate(namespace)
+
+
+# タグのついたページのキャッシュを無効にする
+# コミットの前に呼び、他のプロセスにもタグの世代をデータベースで知らせる
+# このプロセスのキャッシュはコミットしてから無効にする（commit_and_invalidate）
+# 先に無効にすると、コミットまでの間に古い内容で描画したページが新しい世代で保存されてしまう
+def invalidate_pages(*tags):
+    in_transaction = get_db().in_transaction
+    bump_generations(*tags)
+    if in_transaction:
+        g.setdefault('invalidated_tags', set()).update(tags)
+    else:
+        current_app.extensions['flaskr_response_cache'].invalidate(*tags)
+
+
+# 書き込みをコミットし、invalidate_pagesで指定したタグのページをこのプロセスのキャッシュから捨てる
+def commit_and_invalidate():
+    get_db().commit()
+    _invalidate_pending()
+
+
+def _invalidate_pending(exception=None):
+    tags = g.pop('invalidated_tags', None)
+    if tags:
+        current_app.extensions['flaskr_response_cache'].invalidate(*tags)
+
+
+# レスポンスのキャッシュをアプリケーションに登録する
+def init_app(app):
+    app.extensions['flaskr_response_cache'] = ResponseCache(make_backend(app))
+    app.extensions['flaskr_cache_generations'] = Generations()
+    # commit_and_invalidateを通らなかった（ロールバックした）ときも、残ったタグは無効にしておく
+    app.teardown_appcontext(_invalidate_pending)
@@ -0,0 +1,188 @@
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from flaskr.assets import is_compressed_type
+
+try:
+    import brotli
+except ImportError:  # brotliがなければgzipだけで圧縮する
+    brotli = None
+
+
+# 本文がない・本文の一部だけのステータスは圧縮しない
+SKIP_STATUSES = (204, 206, 304)
+
+
+class _Gzip:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    # ここまでの本文をクライアントが展開できるように送り出す
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+# Accept-Encodingに応じてレスポンスの本文を圧縮するWSGIミドルウェア
+# 設定は config から毎回読むので、作った後に変えても反映される
+class CompressMiddleware:
+    def __init__(self, wsgi_app, config):
+        self.wsgi_app = wsgi_app
+        self.config = config
+
+    def negotiate(self, environ):
+        """使う圧縮の種類（圧縮しないならNone）"""
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        if brotli is not None and self.config['COMPRESS_BROTLI_QUALITY'] is not None and accept['br']:
+            return 'br'
+        if accept['gzip']:
+            return 'gzip'
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ)
+        # 圧縮した本文のETagには接尾辞を付けているので、アプリケーションには元のETagで問い合わせる
+        suffix = f'-{encoding}"'
+        if encoding is not None and suffix in environ.get('HTTP_IF_NONE_MATCH', ''):
+            environ['HTTP_IF_NONE_MATCH'] = environ['HTTP_IF_NONE_MATCH'].replace(suffix, '"')
+        else:
+            suffix = None
+
+        captured = []
+        server_write = []
+
+        # write()を使うアプリケーション（古いWSGIの書き方）のレスポンスは圧縮せず、そのまま送る
+        def write(data):
+            if not server_write:
+                status, headers, exc_info = captured
+                server_write.append(start_response(status, headers.to_wsgi_list(), exc_info))
+            server_write[0](data)
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, Headers(headers), exc_info]
+            return write
+
+        app_iter = self.wsgi_app(environ, capture)
+        if server_write:
+            return app_iter
+        status, headers, exc_info = captured
+        status_code = int(status.split(' ', 1)[0])
+        mimetype = headers.get('Content-Type', '').split(';', 1)[0].strip()
+
+        # 圧縮した本文に対する304には、クライアントが持っている（接尾辞つきの）ETagを返す
+        if status_code == 304 and suffix is not None:
+            self._suffix_etag(headers, encoding)
+            self._add_vary(headers)
+
+        # 圧縮済み・変換を禁じられた・圧縮が効かない種類の本文はそのまま返す
+        if ('Content-Encoding' in headers or 'no-transform' in headers.get('Cache-Control', '')
+                or not mimetype or is_compressed_type(mimetype)):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        self._add_vary(headers)
+        if status_code in SKIP_STATUSES or encoding is None:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        length = headers.get('Content-Length', type=int)
+        if length is not None and length < self.config['COMPRESS_MIN_SIZE']:
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        return self._compress(app_iter, encoding, status, headers, exc_info, start_response,
+                              streamed=length is None)
+
+    # 圧縮するかどうかで本文が変わるので、キャッシュにAccept-Encodingごとに分けさせる
+    @staticmethod
+    def _add_vary(headers):
+        vary = headers.get('Vary')
+        if not vary:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = f'{vary}, Accept-Encoding'
+
+    @staticmethod
+    def _suffix_etag(headers, encoding):
+        etag = headers.get('ETag')
+        if etag and etag.endswith('"'):
+            headers['ETag'] = f'{etag[:-1]}-{encoding}"'
+
+    def _compressor(self, encoding):
+        if encoding == 'br':
+            return _Brotli(self.config['COMPRESS_BROTLI_QUALITY'])
+        return _Gzip(self.config['COMPRESS_LEVEL'])
+
+    def _compress(self, app_iter, encoding, status, headers, exc_info, start_response, streamed):
+        """本文を圧縮して返す
+
+        長さのわからない（ストリーミングの）本文は COMPRESS_MIN_SIZE に届くまで貯め、
+        届かずに終われば圧縮しない。圧縮するときは、ストリーミングならチャンクごとに
+        送り出して（クライアントは届いた分から表示できる）、そうでなければ最後にまとめて返す
+        """
+        min_size = self.config['COMPRESS_MIN_SIZE']
+        try:
+            chunks = iter(app_iter)
+            head = []
+            size = 0
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= min_size:
+                    break
+            else:
+                headers['Content-Length'] = str(size)
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                yield b''.join(head)
+                return
+
+            compressor = self._compressor(encoding)
+            headers.remove('Content-Length')
+            headers['Content-Encoding'] = encoding
+            self._suffix_etag(headers, encoding)
+            start_response(status, headers.to_wsgi_list(), exc_info)
+
+            if not streamed:
+                body = [compressor.compress(b''.join(head))]
+                body.extend(compressor.compress(chunk) for chunk in chunks)
+                body.append(compressor.finish())
+                yield b''.join(body)
+                return
+
+            yield compressor.compress(b''.join(head)) + compressor.flush()
+            for chunk in chunks:
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush()
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+# レスポンスの圧縮をアプリケーションに登録する
+def init_app(app):
+    if app.config['COMPRESS_ENABLED']:
+        app.wsgi_app = CompressMiddleware(app.wsgi_app, app.config)
@@ -1,28 +1,122 @@
+import os
 import sqlite3
+import threading
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+from flaskr.instrument import InstrumentedConnection
+
+
+# SQLiteの接続のプール
+# リクエストごとに接続を作り直さず、接続（とそのページキャッシュ・文キャッシュ）を使い回す
+# アプリケーションに1つ作り、複数のスレッドで共有する
+class ConnectionPool:
+    def __init__(self, config):
+        self.config = config
+        self.created = 0
+        self.in_use = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    # 新しい接続を作り、設定に従ってPRAGMAを実行する
+    def connect(self):
+        config = self.config
+        db = sqlite3.connect(
+            config['DATABASE'],
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=config['DATABASE_CACHED_STATEMENTS'],
+            check_same_thread=False,
+            factory=InstrumentedConnection if (
+                config['SQL_INSTRUMENTATION'] or config['SLOW_QUERY_THRESHOLD_MS'] is not None
+            ) else sqlite3.Connection,
+        )
+        db.row_factory = sqlite3.Row
+        db.execute(f"PRAGMA busy_timeout = {int(config['DATABASE_BUSY_TIMEOUT'])}")
+        db.execute(f"PRAGMA journal_mode = {config['DATABASE_JOURNAL_MODE']}")
+        db.execute(f"PRAGMA synchronous = {config['DATABASE_SYNCHRONOUS']}")
+        db.execute(f"PRAGMA mmap_size = {int(config['DATABASE_MMAP_SIZE'])}")
+        db.execute(f"PRAGMA cache_size = {int(config['DATABASE_CACHE_SIZE'])}")
+        db.execute(f"PRAGMA foreign_keys = {'ON' if config['DATABASE_FOREIGN_KEYS'] else 'OFF'}")
+        # 接続時のPRAGMAは計測に含めない
+        if isinstance(db, InstrumentedConnection):
+            if config['SQL_INSTRUMENTATION']:
+                db.max_statements = config['SQL_INSTRUMENTATION_MAX_STATEMENTS']
+            if config['SLOW_QUERY_THRESHOLD_MS'] is not None:
+                db.slow_query_threshold = config['SLOW_QUERY_THRESHOLD_MS'] / 1000
+                db.slow_query_log = config['SLOW_QUERY_LOG']
+                db.slow_query_redact = config['SLOW_QUERY_REDACT']
+            db.reset()
+        with self._lock:
+            self.created += 1
+        return db
+
+    # 空いている接続を取り出す（なければ新しく作る）
+    def acquire(self):
+        with self._lock:
+            self.in_use += 1
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self.connect()
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+            raise
+
+    # 接続をプールに戻す
+    # 途中のトランザクションはロールバックし、プールが一杯なら閉じる
+    def release(self, db):
+        with self._lock:
+            self.in_use -= 1
+        try:
+            if db.in_transaction:
+                db.rollback()
+            db.row_factory = sqlite3.Row
+            db.set_trace_callback(None)
+            if isinstance(db, InstrumentedConnection):
+                db.reset()
+        except sqlite3.Error:
+            db.close()
+            return
+
+        with self._lock:
+            if len(self._idle) < self.config['DATABASE_POOL_SIZE']:
+                self._idle.append(db)
+                return
+        db.close()
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    # プールの接続をすべて閉じる
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            db.close()
+
+
+def get_pool():
+    return current_app.extensions['flaskr_db_pool']
+
 
 # データベースに接続する
 # 同じリクエスト中にすでに接続している場合は接続しているDBを返す
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
     return g.db
 
 
-# データベースの接続を閉じる
+# データベースの接続をプールに戻す
 def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        get_pool().release(db)
 
 
 # データベースを初期化
@@ -33,6 +127,59 @@ def init_db():
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    # 削除で空いたページを db-maintain で少しずつファイルから返せるようにする
+    # （作った後のデータベースに反映するにはVACUUMが要るが、空なのですぐ終わる）
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('VACUUM')
+
+    # schema.sqlは最新のスキーマなので、マイグレーションはすべて適用済みとする
+    db.execute(f'PRAGMA user_version = {get_migrations()[-1][0]}')
+
+
+# マイグレーションの一覧を (バージョン, ファイル名) のバージョン順で返す
+# migrations/NNNN_説明.sql のNNNNがバージョン（PRAGMA user_version）になる
+def get_migrations():
+    migrations = []
+    for name in os.listdir(os.path.join(current_app.root_path, 'migrations')):
+        version, _, _ = name.partition('_')
+        if name.endswith('.sql') and version.isdigit():
+            migrations.append((int(version), name))
+    return sorted(migrations)
+
+
+# データを残したままスキーマを最新にする
+# 未適用のマイグレーションを1つずつトランザクション内で実行し、
+# 最後にANALYZEでクエリプランナ用の統計を更新する
+# 表を作り直すマイグレーションがあるので、実行中は外部キーを無効にする（トランザクションの外でしか切り替えられない）
+def upgrade_db():
+    db = get_db()
+    current = db.execute('PRAGMA user_version').fetchone()[0]
+    foreign_keys = db.execute('PRAGMA foreign_keys').fetchone()[0]
+    applied = []
+
+    db.execute('PRAGMA foreign_keys = OFF')
+    try:
+        for version, name in get_migrations():
+            if version <= current:
+                continue
+            with current_app.open_resource(f'migrations/{name}') as f:
+                script = f.read().decode('utf8')
+            try:
+                db.executescript(
+                    f'BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;'
+                )
+            except sqlite3.Error:
+                db.rollback()
+                raise
+            applied.append(name)
+    finally:
+        db.execute(f'PRAGMA foreign_keys = {foreign_keys}')
+
+    db.execute('PRAGMA analysis_limit = 1000')
+    db.execute('ANALYZE')
+    db.commit()
+    return applied
+
 
 # 開発用の初期データの読み込みと実行
 def insert_init_data():
@@ -42,6 +189,111 @@ def insert_init_data():
         db.executescript(f.read().decode('utf8'))
 
 
+# 投稿のコメント数・投票数をcomment, voteテーブルから数え直す
+# トリガーで更新している値がずれてしまったときに使う
+# ずれていた投稿は表示が変わるので版数も進め、その件数を返す
+def rebuild_counters():
+    db = get_db()
+    comment_count = '(SELECT count(*) FROM comment WHERE post_id = post.id)'
+    agree = '(SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 1)'
+    disagree = '(SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 0)'
+    cur = db.execute(
+        f'UPDATE post SET comment_count = {comment_count},'
+        f' agree = {agree}, disagree = {disagree},'
+        ' version = version + 1, updated = CURRENT_TIMESTAMP'
+        f' WHERE comment_count != {comment_count}'
+        f' OR agree != {agree} OR disagree != {disagree}'
+    )
+    db.commit()
+    return cur.rowcount
+
+
+# 参照先の行がなくなったコメント・投票を探すための (キー, 条件)
+# 外部キーを有効にする前に投稿を削除したときに残ったもの
+ORPHANS = {
+    'comment': (('id',), 'NOT EXISTS (SELECT 1 FROM post WHERE post.id = comment.post_id)'
+                         ' OR NOT EXISTS (SELECT 1 FROM user WHERE user.id = comment.commenter_id)'),
+    'vote': (('post_id', 'user_id'), 'NOT EXISTS (SELECT 1 FROM post WHERE post.id = vote.post_id)'
+                                     ' OR NOT EXISTS (SELECT 1 FROM user WHERE user.id = vote.user_id)'),
+}
+
+
+# 参照先のないコメント・投票を batch_size 件ずつ削除し、削除した件数を返す
+# 1回のトランザクションは batch_size 件の削除だけなので、動いているアプリケーションを長く待たせない
+def delete_orphans(table: str, batch_size: int = 1000):
+    db = get_db()
+    key, condition = ORPHANS[table]
+    columns = ', '.join(key)
+    deleted = 0
+    last = None
+    while True:
+        # キーの順に前回の続きから探す
+        where = condition if last is None else \
+            f'({columns}) > ({", ".join("?" * len(key))}) AND ({condition})'
+        rows = db.execute(
+            f'SELECT {columns} FROM {table} WHERE {where} ORDER BY {columns} LIMIT ?',
+            (*(last or ()), batch_size)
+        ).fetchall()
+        if not rows:
+            return deleted
+        db.executemany(
+            f'DELETE FROM {table} WHERE {" AND ".join(f"{column} = ?" for column in key)}',
+            [tuple(row) for row in rows]
+        )
+        db.commit()
+        deleted += len(rows)
+        last = tuple(rows[-1])
+
+
+def _file_size(path: str) -> int:
+    """データベースとWALのファイルの大きさの合計"""
+    return sum(os.path.getsize(p) for p in (path, f'{path}-wal') if os.path.exists(p))
+
+
+# データベースの保守をまとめて行い、結果を返す
+# 参照先のない行の削除・統計の更新・空きページの返却・WALのチェックポイントの順で行う
+# full が真ならVACUUMでファイルを作り直す（その間は書き込めないので、止めてから行う）
+def maintain_db(batch_size: int = 1000, vacuum_pages: int = 1000, full: bool = False):
+    db = get_db()
+    path = current_app.config['DATABASE']
+    page_size = db.execute('PRAGMA page_size').fetchone()[0]
+    report = {
+        'size_before': _file_size(path),
+        'freelist_before': db.execute('PRAGMA freelist_count').fetchone()[0],
+        'orphans': {table: delete_orphans(table, batch_size) for table in ORPHANS},
+    }
+
+    db.execute('PRAGMA analysis_limit = 1000')
+    db.execute('ANALYZE')
+    db.execute('PRAGMA optimize')
+    db.commit()
+
+    if full:
+        # auto_vacuumの設定はVACUUMで反映される
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('VACUUM')
+    elif db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        # 空きページを vacuum_pages ずつファイルの末尾から返す（減らなくなるまで）
+        free = db.execute('PRAGMA freelist_count').fetchone()[0]
+        while free:
+            db.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})').fetchall()
+            remaining = db.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free:
+                break
+            free = remaining
+    report['incremental'] = db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    report['freelist_after'] = db.execute('PRAGMA freelist_count').fetchone()[0]
+
+    # 読み込み中の接続があって最後まで書き戻せなければ busy が1になる
+    busy, log, checkpointed = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    report['checkpoint'] = {'busy': busy, 'log': log, 'checkpointed': checkpointed}
+    report['size_after'] = _file_size(path)
+    report['reclaimed'] = report['size_before'] - report['size_after']
+    report['pages_freed'] = report['freelist_before'] - report['freelist_after']
+    report['page_size'] = page_size
+    return report
+
+
 # カスタムコマンドの定義
 # シェルから flask init-db を実行可能にする
 @click.command('init-db')
@@ -60,9 +312,60 @@ def init_db_data_command():
     click.echo('Initialized the database and insert initial data.')
 
 
+# マイグレーションを適用するカスタムコマンド
+# init-dbと違いテーブルを作り直さないので稼働中のデータベースに使える
+@click.command('db-upgrade')
+@with_appcontext
+def upgrade_db_command():
+    for name in upgrade_db():
+        click.echo(f'Applied {name}.')
+    click.echo('The database is up to date.')
+
+
+# 投稿のコメント数・投票数を数え直すカスタムコマンド
+@click.command('rebuild-counters')
+@with_appcontext
+def rebuild_counters_command():
+    count = rebuild_counters()
+    click.echo(f'Rebuilt counters of {count} posts.')
+
+
+# データベースの保守を行うカスタムコマンド
+# --full を付けなければ短いトランザクションしか使わないので、アプリケーションを動かしたまま実行できる
+@click.command('db-maintain')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Orphaned rows deleted per transaction.')
+@click.option('--vacuum-pages', default=1000, show_default=True,
+              help='Free pages released per incremental vacuum step.')
+@click.option('--full', is_flag=True,
+              help='Rebuild the file with VACUUM and enable incremental vacuum (blocks writers).')
+@with_appcontext
+def maintain_db_command(batch_size, vacuum_pages, full):
+    report = maintain_db(batch_size, vacuum_pages, full)
+    orphans = ', '.join(f'{count} {table}' for table, count in report['orphans'].items())
+    click.echo(f'Deleted orphaned rows: {orphans}.')
+    click.echo('Updated the query planner statistics.')
+    click.echo(f"Released {report['pages_freed']} free pages"
+               f" ({report['freelist_after']} left, page size {report['page_size']}).")
+    if not report['incremental']:
+        click.echo('Incremental vacuum is off for this database; run with --full once to enable it.')
+    checkpoint = report['checkpoint']
+    if checkpoint['busy']:
+        click.echo(f"WAL checkpoint was blocked by readers ({checkpoint['checkpointed']}"
+                   f" of {checkpoint['log']} frames written back).")
+    else:
+        click.echo('Checkpointed and truncated the WAL.')
+    click.echo(f"Database size {report['size_before']} -> {report['size_after']} bytes"
+               f" ({report['reclaimed']} bytes reclaimed).")
+
+
 # カスタムコマンドをアプリケーション（のインスタンス）に登録する関数
 # アプリケーションのインスタンスに対して設定する
 def init_app(app):
+    app.extensions['flaskr_db_pool'] = ConnectionPool(app.config)
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
-    app.cli.add_command(init_db_data_command)
\ No newline at end of file
+    app.cli.add_command(init_db_data_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(rebuild_counters_command)
+    app.cli.add_command(maintain_db_command)
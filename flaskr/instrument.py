@@ -0,0 +1,234 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import with_appcontext
+
+
+# 実行したSQLの件数と時間を記録する接続
+# SQL_INSTRUMENTATIONが有効か SLOW_QUERY_THRESHOLD_MS が設定されているときだけ、プールがこのクラスで接続を作る
+# （どちらも無効なら素のsqlite3.Connection）
+# 時間はexecuteの呼び出しの分だけ（SELECTは最初の1行を取り出すまで）を測る
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_statements = 0
+        # 遅いクエリとして記録する時間（秒、Noneなら記録しない）と記録先
+        self.slow_query_threshold = None
+        self.slow_query_log = None
+        self.slow_query_redact = True
+        self.reset()
+
+    # 記録を消す（接続をプールに戻すときに呼ぶ）
+    def reset(self):
+        self.query_count = 0
+        self.query_time = 0.0
+        self.statements = []
+
+    def _call(self, method, sql, *args):
+        begin = time.perf_counter()
+        succeeded = False
+        try:
+            result = method(self, sql, *args)
+            succeeded = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - begin
+            self.query_count += 1
+            self.query_time += elapsed
+            # 1つの接続で大量に実行しても記録が膨らまないよう、文ごとの時間は上限まで残す
+            if len(self.statements) < self.max_statements:
+                self.statements.append((sql, elapsed))
+            if (succeeded and self.slow_query_threshold is not None
+                    and elapsed >= self.slow_query_threshold):
+                log_slow_query(self, method.__name__, sql, args, elapsed)
+
+    def execute(self, sql, *args):
+        return self._call(sqlite3.Connection.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._call(sqlite3.Connection.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._call(sqlite3.Connection.executescript, sql)
+
+
+# SQLを1行に縮めて先頭だけ残す（ヘッダーとログ用）
+def summarize(sql: str, length: int = 60) -> str:
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= length else sql[:length - 3] + '...'
+
+
+def _quote(text: str) -> str:
+    return '"' + re.sub(r'(["\\])', r'\\\1', text) + '"'
+
+
+# パラメータの値を型と長さだけにする
+def redact(parameters):
+    def mask(value):
+        if value is None:
+            return None
+        if isinstance(value, (str, bytes)):
+            return f'<{type(value).__name__}:{len(value)}>'
+        return f'<{type(value).__name__}>'
+
+    if isinstance(parameters, dict):
+        return {name: mask(value) for name, value in parameters.items()}
+    return [mask(value) for value in parameters]
+
+
+# EXPLAIN QUERY PLAN の結果を、入れ子を字下げした行のリストにする
+def explain(db, sql, parameters=()) -> list:
+    try:
+        rows = sqlite3.Connection.execute(db, f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f'(EXPLAIN failed: {e})']
+    depth = {0: -1}
+    plan = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        plan.append('  ' * depth[node] + detail)
+    return plan
+
+
+_slow_query_lock = threading.Lock()
+
+
+# 遅いクエリを、パラメータ・時間・エンドポイント・実行計画とともにJSON1行で記録する
+def log_slow_query(db, method, sql, args, elapsed):
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'ms': round(elapsed * 1000, 3),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'sql': ' '.join(sql.split()),
+    }
+    if method == 'execute':
+        parameters = args[0] if args else ()
+        if db.slow_query_redact:
+            entry['params'] = redact(parameters)
+        else:
+            entry['params'] = parameters if isinstance(parameters, dict) else list(parameters)
+        entry['plan'] = explain(db, sql, parameters)
+    else:
+        # executemany・executescriptは文ごとの計画を取れないので時間だけ残す
+        entry['method'] = method
+
+    line = json.dumps(entry, ensure_ascii=False, default=repr)
+    with _slow_query_lock, open(db.slow_query_log, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+
+# 記録した遅いクエリを読み込む（壊れた行は飛ばす）
+def read_slow_queries(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+# 遅いクエリをSQLごとにまとめ、合計時間の長い順に返す
+def summarize_slow_queries(entries) -> list:
+    groups = {}
+    for entry in entries:
+        group = groups.setdefault(entry['sql'], {
+            'sql': entry['sql'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            'endpoints': set(), 'plan': entry.get('plan', []),
+        })
+        group['count'] += 1
+        group['total_ms'] += entry['ms']
+        group['max_ms'] = max(group['max_ms'], entry['ms'])
+        if entry.get('endpoint'):
+            group['endpoints'].add(entry['endpoint'])
+    return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
+
+
+def start_timer():
+    if current_app.config['SQL_INSTRUMENTATION']:
+        g.request_started = time.perf_counter()
+
+
+# リクエストで実行したSQLの件数と時間をServer-Timingヘッダーと構造化ログ（JSON1行）に出す
+def report_queries(response):
+    if not current_app.config['SQL_INSTRUMENTATION'] or 'request_started' not in g:
+        return response
+
+    db = g.get('db')
+    if not isinstance(db, InstrumentedConnection):
+        count, total, statements = 0, 0.0, []
+    else:
+        count, total, statements = db.query_count, db.query_time, db.statements
+    elapsed = time.perf_counter() - g.request_started
+
+    timings = [
+        f'db;dur={total * 1000:.2f};desc="{count} queries"',
+        f'app;dur={elapsed * 1000:.2f}',
+    ]
+    timings.extend(
+        f'sql-{n};dur={seconds * 1000:.2f};desc={_quote(summarize(sql))}'
+        for n, (sql, seconds) in enumerate(statements, 1)
+    )
+    response.headers.add('Server-Timing', ', '.join(timings))
+
+    current_app.logger.getChild('sql').info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'queries': count,
+        'sql_ms': round(total * 1000, 3),
+        'total_ms': round(elapsed * 1000, 3),
+        'statements': [
+            {'sql': summarize(sql, 200), 'ms': round(seconds * 1000, 3)}
+            for sql, seconds in statements
+        ],
+    }, ensure_ascii=False))
+    return response
+
+
+# 遅いクエリの記録をまとめて表示するカスタムコマンド
+# 計画に全件走査（SCAN）や一時B-tree（USE TEMP B-TREE）があるものに印を付ける
+@click.command('slow-queries')
+@click.option('--limit', default=10, show_default=True, help='Number of statements to show.')
+@click.option('--log', 'path', type=click.Path(dir_okay=False),
+              help='Log file (default: SLOW_QUERY_LOG).')
+@with_appcontext
+def slow_queries_command(limit, path):
+    path = path or current_app.config['SLOW_QUERY_LOG']
+    try:
+        groups = summarize_slow_queries(read_slow_queries(path))
+    except FileNotFoundError:
+        raise click.ClickException(f'No slow query log at {path}.')
+
+    click.echo(f'{len(groups)} slow statements in {path}.')
+    for group in groups[:limit]:
+        flags = [flag for flag, found in (
+            ('full scan', any(line.strip().startswith('SCAN ') for line in group['plan'])),
+            ('temp b-tree', any('TEMP B-TREE' in line for line in group['plan'])),
+        ) if found]
+        click.echo('')
+        click.echo(f"{group['count']:>6} x  total {group['total_ms']:.1f} ms"
+                   f"  max {group['max_ms']:.1f} ms"
+                   f"  avg {group['total_ms'] / group['count']:.1f} ms"
+                   + (f"  [{', '.join(flags)}]" if flags else ''))
+        click.echo(f"  {summarize(group['sql'], 200)}")
+        if group['endpoints']:
+            click.echo(f"  endpoints: {', '.join(sorted(group['endpoints']))}")
+        for line in group['plan']:
+            click.echo(f'    {line}')
+
+
+def init_app(app):
+    app.cli.add_command(slow_queries_command)
+    app.before_request(start_timer)
+    app.after_request(report_queries)
+    # ログはアプリケーションのロガーの子（flaskr.sql）にINFOで出す
+    logger = app.logger.getChild('sql')
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
@@ -0,0 +1,227 @@
+import bisect
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import abort, current_app, g, request
+
+
+# レスポンス時間のヒストグラムのバケットの上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# プロセス内のメトリクス
+# 1リクエストで取るロックは1回だけで、ロックの中では辞書とリストの加算しかしない
+class Registry:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # (エンドポイント, メソッド, ステータス) ごとのリクエスト数
+        self.requests = {}
+        # エンドポイントごとの [バケットごとの件数..., +Infの件数, 合計時間]
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, method: str, status: int, seconds: float):
+        key = (endpoint, method, status)
+        # le（以下）なので値と等しいバケットに入れる
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.get(endpoint)
+            if histogram is None:
+                histogram = self.durations[endpoint] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    # JSONに書き出せる形の写し
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'requests': [[*key, count] for key, count in self.requests.items()],
+                'durations': {endpoint: list(h) for endpoint, h in self.durations.items()},
+            }
+
+
+# プールとキャッシュの統計
+# counters はプロセスが終わっても合計に残し、gauges は動いているプロセスの分だけ合計する
+def collect_stats(app) -> dict:
+    pool = app.extensions['flaskr_db_pool']
+    counters = {'db_connections_created': pool.created}
+    gauges = {'db_connections_idle': pool.idle, 'db_connections_in_use': pool.in_use}
+
+    caches = {'response': app.extensions['flaskr_response_cache'].backend}
+    if 'flaskr_user_cache' in app.extensions:
+        caches['user'] = app.extensions['flaskr_user_cache']
+    for name, cache in caches.items():
+        counters[f'cache_hits:{name}'] = cache.hits
+        counters[f'cache_misses:{name}'] = cache.misses
+        gauges[f'cache_entries:{name}'] = len(cache)
+    return {'counters': counters, 'gauges': gauges}
+
+
+# METRICS_DIR にこのプロセスの写しを書き出す（他のプロセスの /metrics から読む）
+# 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+def write_snapshot(app):
+    directory = app.config['METRICS_DIR']
+    snapshot = {'pid': os.getpid(), **app.extensions['flaskr_metrics'].snapshot(),
+                **collect_stats(app)}
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# すべてのプロセスの写しを合計する（METRICS_DIR がなければこのプロセスの分だけ）
+def aggregate(app) -> list:
+    if not app.config['METRICS_DIR']:
+        return [{'pid': os.getpid(), **app.extensions['flaskr_metrics'].snapshot(),
+                 **collect_stats(app)}]
+
+    write_snapshot(app)
+    snapshots = []
+    for path in glob.glob(os.path.join(app.config['METRICS_DIR'], 'metrics-*.json')):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+# Prometheusのテキスト形式に書き出す
+def render(snapshots, buckets=BUCKETS) -> str:
+    requests, errors, durations = {}, {}, {}
+    counters, gauges = {}, {}
+    for snapshot in snapshots:
+        for endpoint, method, status, count in snapshot['requests']:
+            key = (endpoint, method, str(status))
+            requests[key] = requests.get(key, 0) + count
+            if status >= 500:
+                errors[endpoint] = errors.get(endpoint, 0) + count
+        for endpoint, histogram in snapshot['durations'].items():
+            total = durations.setdefault(endpoint, [0] * len(histogram))
+            for i, value in enumerate(histogram):
+                total[i] += value
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        if snapshot['pid'] == os.getpid() or _alive(snapshot['pid']):
+            for name, value in snapshot['gauges'].items():
+                gauges[name] = gauges.get(name, 0) + value
+
+    lines = [
+        '# HELP flaskr_requests_total Requests by endpoint, method and status.',
+        '# TYPE flaskr_requests_total counter',
+    ]
+    for (endpoint, method, status), count in sorted(requests.items()):
+        lines.append(f'flaskr_requests_total'
+                     f'{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+    lines += [
+        '# HELP flaskr_request_errors_total Requests answered with a 5xx status.',
+        '# TYPE flaskr_request_errors_total counter',
+    ]
+    for endpoint, count in sorted(errors.items()):
+        lines.append(f'flaskr_request_errors_total{_labels(endpoint=endpoint)} {count}')
+
+    lines += [
+        '# HELP flaskr_request_duration_seconds Request latency by endpoint.',
+        '# TYPE flaskr_request_duration_seconds histogram',
+    ]
+    for endpoint, histogram in sorted(durations.items()):
+        cumulative = 0
+        for bound, count in zip((*buckets, '+Inf'), histogram):
+            cumulative += count
+            lines.append(f'flaskr_request_duration_seconds_bucket'
+                         f'{_labels(endpoint=endpoint, le=bound)} {cumulative}')
+        lines.append(f'flaskr_request_duration_seconds_sum{_labels(endpoint=endpoint)}'
+                     f' {histogram[-1]:.6f}')
+        lines.append(f'flaskr_request_duration_seconds_count{_labels(endpoint=endpoint)}'
+                     f' {cumulative}')
+
+    for kind, values in (('counter', counters), ('gauge', gauges)):
+        metrics = {}
+        for name, value in values.items():
+            metric, _, cache = name.partition(':')
+            metrics.setdefault(metric, []).append((cache, value))
+        for metric, samples in sorted(metrics.items()):
+            suffix = '_total' if kind == 'counter' else ''
+            lines.append(f'# TYPE flaskr_{metric}{suffix} {kind}')
+            for cache, value in sorted(samples):
+                labels = _labels(cache=cache) if cache else ''
+                lines.append(f'flaskr_{metric}{suffix}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def start_timer():
+    g.metrics_started = time.perf_counter()
+
+
+# リクエストごとにエンドポイント・メソッド・ステータスと時間を記録する
+def record_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        app = current_app._get_current_object()
+        app.extensions['flaskr_metrics'].observe(
+            request.endpoint or 'unmatched', request.method, response.status_code,
+            time.perf_counter() - started
+        )
+        # 複数のプロセスで動くときは一定の間隔で写しを書き出す
+        if app.config['METRICS_DIR']:
+            now = time.monotonic()
+            if now - app.extensions['flaskr_metrics_flushed'] >= app.config['METRICS_FLUSH_INTERVAL']:
+                app.extensions['flaskr_metrics_flushed'] = now
+                write_snapshot(app)
+    return response
+
+
+# 同じマシンからのリクエストとみなすアドレス
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+# METRICS_TOKEN があればそのトークン、なければ同じマシンからのリクエストだけに返す（それ以外は404）
+def metrics():
+    app = current_app._get_current_object()
+    token = app.config['METRICS_TOKEN']
+    if token is not None:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(credentials.encode(), token.encode()):
+            abort(404)
+    elif request.remote_addr not in LOCAL_ADDRESSES:
+        abort(404)
+    return app.response_class(
+        render(aggregate(app)), mimetype='text/plain; version=0.0.4'
+    )
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.extensions['flaskr_metrics'] = Registry()
+    app.extensions['flaskr_metrics_flushed'] = 0.0
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    app.add_url_rule('/metrics', endpoint='metrics', view_func=metrics)
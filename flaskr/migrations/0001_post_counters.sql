@@ -0,0 +1,67 @@
+-- 投稿にコメント数・投票数のカラムを追加し、集計ビューをやめる
+ALTER TABLE post ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE post ADD COLUMN agree INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE post ADD COLUMN disagree INTEGER NOT NULL DEFAULT 0;
+
+UPDATE post SET
+  comment_count = (SELECT count(*) FROM comment WHERE post_id = post.id),
+  agree = (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 1),
+  disagree = (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 0);
+
+CREATE TRIGGER comment_count_insert AFTER INSERT ON comment
+BEGIN
+  UPDATE post SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER comment_count_delete AFTER DELETE ON comment
+BEGIN
+  UPDATE post SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_insert AFTER INSERT ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0)
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER vote_count_delete AFTER DELETE ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0)
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_update AFTER UPDATE OF post_id, intention ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0)
+    WHERE id = OLD.post_id;
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0)
+    WHERE id = NEW.post_id;
+END;
+
+DROP VIEW all_posts;
+DROP VIEW comment_count;
+DROP VIEW vote_count;
+
+CREATE VIEW all_posts 
+  (id, title, body, created, author_id, 
+  author_name, 
+  comment_count, 
+  agree, disagree)
+AS
+  SELECT
+    p.id, p.title, p.body, p.created, p.author_id,
+    u.username,
+    p.comment_count,
+    p.agree, p.disagree
+  FROM post AS p
+    INNER JOIN user AS u 
+      ON p.author_id = u.id
+;
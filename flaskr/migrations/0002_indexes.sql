@@ -0,0 +1,6 @@
+-- 一覧の並び順・投稿者・コメント・投票の検索用インデックス
+CREATE INDEX IF NOT EXISTS post_created_idx ON post (created, id);
+CREATE INDEX IF NOT EXISTS post_author_idx ON post (author_id);
+CREATE INDEX IF NOT EXISTS comment_post_idx ON comment (post_id, created);
+CREATE INDEX IF NOT EXISTS comment_commenter_idx ON comment (commenter_id);
+CREATE INDEX IF NOT EXISTS vote_post_user_idx ON vote (post_id, user_id);
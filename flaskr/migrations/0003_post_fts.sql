@@ -0,0 +1,37 @@
+-- タイトル・本文・作者名の全文検索用のFTS5テーブル
+-- 中身はall_postsビューを参照し（external content）、索引だけを持つ
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, author_name,
+  content = 'all_posts', content_rowid = 'id',
+  tokenize = 'unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post
+BEGIN
+  INSERT INTO post_fts (rowid, title, body, author_name)
+    SELECT NEW.id, NEW.title, NEW.body, username FROM user WHERE id = NEW.author_id;
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body, author_name)
+    SELECT 'delete', OLD.id, OLD.title, OLD.body, username FROM user WHERE id = OLD.author_id;
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body, author_id ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body, author_name)
+    SELECT 'delete', OLD.id, OLD.title, OLD.body, username FROM user WHERE id = OLD.author_id;
+  INSERT INTO post_fts (rowid, title, body, author_name)
+    SELECT NEW.id, NEW.title, NEW.body, username FROM user WHERE id = NEW.author_id;
+END;
+
+CREATE TRIGGER post_fts_user_update AFTER UPDATE OF username ON user
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body, author_name)
+    SELECT 'delete', id, title, body, OLD.username FROM post WHERE author_id = OLD.id;
+  INSERT INTO post_fts (rowid, title, body, author_name)
+    SELECT id, title, body, NEW.username FROM post WHERE author_id = NEW.id;
+END;
+
+INSERT INTO post_fts (post_fts) VALUES ('rebuild');
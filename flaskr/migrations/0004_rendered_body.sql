@@ -0,0 +1,22 @@
+-- 作成・更新時に変換した本文のHTMLと一覧用の抜粋を保存する
+-- 既存の投稿は flask render-posts で変換する
+ALTER TABLE post ADD COLUMN body_html TEXT;
+ALTER TABLE post ADD COLUMN excerpt TEXT;
+
+DROP VIEW all_posts;
+
+CREATE VIEW all_posts 
+  (id, title, body, excerpt, created, author_id, 
+  author_name, 
+  comment_count, 
+  agree, disagree)
+AS
+  SELECT
+    p.id, p.title, p.body, p.excerpt, p.created, p.author_id,
+    u.username,
+    p.comment_count,
+    p.agree, p.disagree
+  FROM post AS p
+    INNER JOIN user AS u 
+      ON p.author_id = u.id
+;
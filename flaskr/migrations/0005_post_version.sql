@@ -0,0 +1,77 @@
+-- 表示が変わる書き込みのたびに進める版数と日時（ETag・Last-Modified用）
+ALTER TABLE post ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+ALTER TABLE post ADD COLUMN updated TIMESTAMP;
+
+DROP TRIGGER comment_count_insert;
+DROP TRIGGER comment_count_delete;
+DROP TRIGGER vote_count_insert;
+DROP TRIGGER vote_count_delete;
+DROP TRIGGER vote_count_update;
+
+CREATE TRIGGER comment_count_insert AFTER INSERT ON comment
+BEGIN
+  UPDATE post
+    SET comment_count = comment_count + 1,
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER comment_count_delete AFTER DELETE ON comment
+BEGIN
+  UPDATE post
+    SET comment_count = comment_count - 1,
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_insert AFTER INSERT ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER vote_count_delete AFTER DELETE ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_update AFTER UPDATE OF post_id, intention ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+DROP VIEW all_posts;
+
+CREATE VIEW all_posts 
+  (id, title, body, excerpt, created, author_id, 
+  author_name, 
+  comment_count, 
+  agree, disagree,
+  version, updated)
+AS
+  SELECT
+    p.id, p.title, p.body, p.excerpt, p.created, p.author_id,
+    u.username,
+    p.comment_count,
+    p.agree, p.disagree,
+    p.version, p.updated
+  FROM post AS p
+    INNER JOIN user AS u 
+      ON p.author_id = u.id
+;
@@ -0,0 +1,56 @@
+-- voteを (post_id, user_id) を主キーにしたWITHOUT ROWIDのテーブルに作り直す
+-- 重複している投票は後から入れたものを残す
+CREATE TABLE vote_new (
+  post_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  intention INTEGER NOT NULL,
+  PRIMARY KEY (post_id, user_id),
+  FOREIGN KEY (post_id) REFERENCES post (id),
+  FOREIGN KEY (user_id) REFERENCES user (id)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO vote_new (post_id, user_id, intention)
+  SELECT post_id, user_id, intention FROM vote ORDER BY rowid DESC;
+
+DROP TABLE vote;
+ALTER TABLE vote_new RENAME TO vote;
+
+CREATE TRIGGER vote_count_insert AFTER INSERT ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER vote_count_delete AFTER DELETE ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_update AFTER UPDATE OF post_id, intention ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+-- 重複を取り除いた分の投票数を数え直す
+UPDATE post SET
+  agree = (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 1),
+  disagree = (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 0),
+  version = version + 1, updated = CURRENT_TIMESTAMP
+WHERE agree != (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 1)
+  OR disagree != (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 0);
@@ -0,0 +1,94 @@
+-- 投稿を削除したときにコメント・投票も消えるよう、comment, voteを ON DELETE CASCADE の外部キーで作り直す
+-- 削除済みの投稿・ユーザーを指しているコメント・投票は移さない
+CREATE TABLE comment_new (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  post_id INTEGER NOT NULL,
+  commenter_id INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  body TEXT NOT NULL,
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE,
+  FOREIGN KEY (commenter_id) REFERENCES user (id)
+);
+
+INSERT INTO comment_new (id, post_id, commenter_id, created, body)
+  SELECT id, post_id, commenter_id, created, body FROM comment
+  WHERE post_id IN (SELECT id FROM post) AND commenter_id IN (SELECT id FROM user);
+
+CREATE TABLE vote_new (
+  post_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  intention INTEGER NOT NULL,
+  PRIMARY KEY (post_id, user_id),
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+) WITHOUT ROWID;
+
+INSERT INTO vote_new (post_id, user_id, intention)
+  SELECT post_id, user_id, intention FROM vote
+  WHERE post_id IN (SELECT id FROM post) AND user_id IN (SELECT id FROM user);
+
+DROP TABLE comment;
+ALTER TABLE comment_new RENAME TO comment;
+DROP TABLE vote;
+ALTER TABLE vote_new RENAME TO vote;
+
+CREATE INDEX comment_post_idx ON comment (post_id, created);
+CREATE INDEX comment_commenter_idx ON comment (commenter_id);
+
+CREATE TRIGGER comment_count_insert AFTER INSERT ON comment
+BEGIN
+  UPDATE post
+    SET comment_count = comment_count + 1,
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER comment_count_delete AFTER DELETE ON comment
+BEGIN
+  UPDATE post
+    SET comment_count = comment_count - 1,
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_insert AFTER INSERT ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER vote_count_delete AFTER DELETE ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_update AFTER UPDATE OF post_id, intention ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+-- 移さなかった（削除済みのユーザーの）コメント・投票の分を数え直す
+UPDATE post SET
+  comment_count = (SELECT count(*) FROM comment WHERE post_id = post.id),
+  agree = (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 1),
+  disagree = (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 0),
+  version = version + 1, updated = CURRENT_TIMESTAMP
+WHERE comment_count != (SELECT count(*) FROM comment WHERE post_id = post.id)
+  OR agree != (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 1)
+  OR disagree != (SELECT count(*) FROM vote WHERE post_id = post.id AND intention = 0);
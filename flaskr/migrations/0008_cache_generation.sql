@@ -0,0 +1,8 @@
+-- プロセスごとのキャッシュを無効にするための、名前空間（'list', 'post:<id>', 'user:<id>'）ごとの世代
+-- 世代はすべての名前空間で通しの番号にし、前回より後に進んだ名前空間だけを索引で読めるようにする
+CREATE TABLE cache_generation (
+  namespace TEXT PRIMARY KEY,
+  generation INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX cache_generation_idx ON cache_generation (generation);
@@ -0,0 +1,4 @@
+-- 作者名での検索を新しい順に並べるとき、投稿の行を読まずに索引だけで (created, id) を並べ替えられるようにする
+-- （author_idだけの索引の代わりになる）
+DROP INDEX IF EXISTS post_author_idx;
+CREATE INDEX post_author_created_idx ON post (author_id, created, id);
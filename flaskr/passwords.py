@@ -0,0 +1,33 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+# パスワードのハッシュの計算を決まった数のスレッドで行う
+# pbkdf2は1回で数十ミリ秒CPUを使うので、同時に計算する数を workers に抑えて
+# ログインが集中しても他のリクエストの処理が止まらないようにする
+# 待っている分も含めて max_pending を超えたら 503 を返す
+class PasswordHasher:
+    def __init__(self, method: str, workers: int, max_pending: int, timeout: float):
+        self.method = method
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flaskr-hash')
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self._pending.acquire(timeout=self.timeout):
+            raise ServiceUnavailable('Too many password checks in progress.')
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._pending.release()
+
+    # 設定したハッシュの方式（コスト）でハッシュを作る
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    # 保存されているハッシュとパスワードが一致するか調べる
+    def check(self, pwhash: str, password: str) -> bool:
+        return self._run(check_password_hash, pwhash, password)
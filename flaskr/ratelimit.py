@@ -0,0 +1,43 @@
+import threading
+import time
+
+from flaskr.cache import LRUCache
+
+
+# トークンバケット
+# 最大 capacity 個のトークンが1秒あたり rate 個ずつ補充され、1回の試行で1個使う
+class TokenBucket:
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def consume(self, now: float) -> bool:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# キー（IPアドレス・ユーザー名など）ごとのトークンバケットで試行の回数を制限する
+# バケットは件数の上限つきのLRUキャッシュに置き、古いキーのものから捨てる
+class RateLimiter:
+    def __init__(self, capacity: float, per_minute: float, maxsize: int, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self._buckets = LRUCache(maxsize)
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    # keyでの試行を1回記録し、制限を超えていなければTrueを返す
+    def allow(self, key) -> bool:
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.capacity, self.rate, now)
+                self._buckets.set(key, bucket)
+            return bucket.consume(now)
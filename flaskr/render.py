@@ -0,0 +1,158 @@
+import compileall
+import html
+import os
+import re
+
+import click
+from flask import Markup, current_app, get_flashed_messages, stream_with_context
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+from flaskr.cache import commit_and_invalidate, invalidate_pages
+from flaskr.db import get_db
+
+
+# 一覧に表示する本文の抜粋の文字数
+EXCERPT_LENGTH = 30
+
+# ストリーミングで描画するときに、まとめて送り出すテンプレートの断片の数
+STREAM_BUFFER_SIZE = 16
+
+
+# 本文のmarkdownをHTMLに変換する
+# markdown2は読み込みに時間がかかる（正規表現のコンパイル）ので、最初に変換するときに読み込む
+# 表示は保存済みのHTMLを使うので、多くのワーカーは読み込まずに済む
+def render_body(body: str) -> str:
+    from markdown2 import markdown
+    return markdown(Markup.escape(body), extras=['tables'])
+
+
+# HTMLのタグを取り除く
+def remove_tag(str: str) -> str:
+    return re.sub('<.+?>', ' ', str)
+
+
+# 一覧用の本文の抜粋（タグを取り除いたプレーンテキスト）を作る
+def make_excerpt(body: str) -> str:
+    text = html.unescape(remove_tag(render_body(body[:EXCERPT_LENGTH])))
+    text = ' '.join(text.split())
+    if len(body) > EXCERPT_LENGTH:
+        text += ' ...'
+    return text
+
+
+# 投稿の本文から保存用の (body_html, excerpt) を作る
+# 作成・更新時に一度だけ変換して、表示のたびには変換しない
+def render_post(body: str):
+    return render_body(body), make_excerpt(body)
+
+
+# テンプレートを描画しながら送り出すレスポンスを作る（render_templateのストリーミング版）
+# 描画が終わるまでリクエストのコンテキスト（とデータベースの接続）を残すので、
+# contextにカーソルを渡して描画しながら1行ずつ読むことができる
+def stream_template(template_name: str, **context):
+    app = current_app._get_current_object()
+    # セッションは本文を送り出す前に保存されるので、flashのメッセージはここで取り出しておく
+    # （テンプレートの中で取り出すと、取り出したことがセッションに残らない）
+    get_flashed_messages()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return app.response_class(stream_with_context(stream), mimetype='text/html')
+
+
+# body_htmlが空の投稿（またはすべての投稿）をまとめて変換して保存する
+# 変換の結果が変わった投稿は版数を上げ（ETagが変わる）、ページのキャッシュも無効にする
+def backfill_rendered(batch_size: int = 500, all: bool = False):
+    db = get_db()
+    last_id = 0
+    count = 0
+    while True:
+        rows = db.execute(
+            'SELECT id, body, body_html, excerpt FROM post'
+            ' WHERE id > ? AND (? OR body_html IS NULL)'
+            ' ORDER BY id LIMIT ?',
+            (last_id, all, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+
+        changed = []
+        for row in rows:
+            rendered = render_post(row['body'])
+            if rendered != (row['body_html'], row['excerpt']):
+                changed.append((*rendered, row['id']))
+        if changed:
+            db.executemany(
+                'UPDATE post SET body_html = ?, excerpt = ?,'
+                ' version = version + 1, updated = CURRENT_TIMESTAMP'
+                ' WHERE id = ?',
+                changed
+            )
+            invalidate_pages('list', *(f'post:{id}' for *_, id in changed))
+            commit_and_invalidate()
+        last_id = rows[-1]['id']
+        count += len(rows)
+        yield count
+
+
+# 投稿の本文のHTMLと抜粋を作り直すカスタムコマンド
+@click.command('render-posts')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of posts rendered per transaction.')
+@click.option('--all', 'all_', is_flag=True,
+              help='Re-render every post, not only those without HTML.')
+@with_appcontext
+def render_posts_command(batch_size, all_):
+    count = 0
+    for count in backfill_rendered(batch_size, all_):
+        click.echo(f'Rendered {count} posts...')
+    click.echo(f'Rendered {count} posts in total.')
+
+
+# テンプレートをすべてコンパイルしてバイトコードのキャッシュに入れる
+def precompile_templates() -> int:
+    env = current_app.jinja_env
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+# デプロイ時にテンプレートのバイトコードのキャッシュとPythonの.pycを作っておくカスタムコマンド
+# ワーカーが起動してから最初のリクエストでテンプレートをコンパイルせずに済む
+@click.command('precompile')
+@with_appcontext
+def precompile_command():
+    if current_app.jinja_env.bytecode_cache is None:
+        click.echo('JINJA_BYTECODE_CACHE_DIR is not set; templates are not cached.')
+    else:
+        count = precompile_templates()
+        click.echo(f'Compiled {count} templates into {current_app.config["JINJA_BYTECODE_CACHE_DIR"]}.')
+    compileall.compile_dir(current_app.root_path, quiet=1)
+    click.echo(f'Compiled Python modules in {current_app.root_path}.')
+
+
+# テンプレートのフィルターとカスタムコマンドをアプリケーションに登録する
+def init_app(app):
+    # コンパイルしたテンプレートをファイルに保存し、ワーカーの間・再起動の後でも使い回す
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    # 保存済みのHTML・抜粋がない投稿を表示するときだけ使う
+    @app.template_filter('markdown')
+    def markdown_filter(str):
+        return render_body(str)
+
+    @app.template_filter('excerpt')
+    def excerpt_filter(str):
+        return make_excerpt(str)
+
+    @app.template_filter('remove_tag')
+    def remove_tag_filter(str):
+        return remove_tag(str)
+
+    app.cli.add_command(render_posts_command)
+    app.cli.add_command(precompile_command)
@@ -1,14 +1,53 @@
 import functools
 
-from flask import Blueprint, flash, redirect, request, url_for, session, g, render_template
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Blueprint, current_app, flash, redirect, request, url_for, session, g, render_template
+from werkzeug.exceptions import TooManyRequests
 
+from flaskr.cache import LRUCache, bump_generations, check_generations
 from flaskr.db import get_db
+from flaskr.passwords import PasswordHasher
+from flaskr.ratelimit import RateLimiter
 
 
 bp = Blueprint('auth', __name__)
 
 
+# ログインユーザーの情報のキャッシュ、パスワードのハッシュ計算、試行回数の制限をアプリケーションに登録する
+@bp.record_once
+def init_auth(state):
+    config = state.app.config
+    state.app.extensions['flaskr_user_cache'] = LRUCache(
+        config['USER_CACHE_SIZE'], ttl=config['USER_CACHE_TTL']
+    )
+    state.app.extensions['flaskr_password_hasher'] = PasswordHasher(
+        config['PASSWORD_HASH_METHOD'], config['PASSWORD_HASH_WORKERS'],
+        config['PASSWORD_HASH_MAX_PENDING'], config['PASSWORD_HASH_TIMEOUT']
+    )
+    state.app.extensions['flaskr_auth_limiter'] = RateLimiter(
+        config['AUTH_RATE_LIMIT_BURST'], config['AUTH_RATE_LIMIT_PER_MINUTE'],
+        config['AUTH_RATE_LIMIT_SIZE']
+    )
+
+
+# ログイン・登録の試行をIPアドレスごと・ユーザー名ごとに制限する
+# 制限を超えたらパスワードのハッシュを計算する前に429を返す
+@bp.before_request
+def limit_attempts():
+    if request.method != 'POST':
+        return
+
+    limiter = current_app.extensions['flaskr_auth_limiter']
+    keys = [f'ip:{request.remote_addr}']
+    if username := request.form.get('username'):
+        keys.append(f'user:{username}')
+    if not all([limiter.allow(key) for key in keys]):
+        raise TooManyRequests('Too many attempts. Please try again later.')
+
+
+def get_hasher() -> PasswordHasher:
+    return current_app.extensions['flaskr_password_hasher']
+
+
 # 登録 '/auth/register' の処理を行う関数を登録
 @bp.get('/register')
 def register():
@@ -35,7 +74,7 @@ def register_post():
     if error is None:
         db.execute(
             'INSERT INTO user (username, password) VALUES (?, ?)',
-            (username, generate_password_hash(password))
+            (username, get_hasher().hash(password))
         )
         db.commit()
         return redirect(url_for('auth.login'))
@@ -63,12 +102,14 @@ def login_post():
     # バリデーション
     if user is None:
         error = 'Incorrect username.'
-    elif not check_password_hash(user['password'], password):
+    elif not get_hasher().check(user['password'], password):
         error = 'Incorrect password.'
 
     if error is None:
         session.clear()
         session['user-id'] = user['id']
+        # このプロセスのキャッシュだけ捨てる（ユーザー情報は変えていないので世代は進めない）
+        current_app.extensions['flaskr_user_cache'].delete(user['id'])
         return redirect(url_for('blog.index'))
     else:
         flash(error)
@@ -92,11 +133,31 @@ def load_logged_in_user():
         # セッションに登録されていなければNoneを格納する
         g.user = None
     else:
-        # セッションに登録されていればユーザーが存在するのでSQLでユーザー情報を取り出して
+        # セッションに登録されていればユーザーが存在するのでユーザー情報を取り出して
         # g（リクエスト中に複数の関数からアクセスできる特別なオブジェクト）に格納する
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
+        g.user = load_user(user_id)
+
+
+# ユーザー情報（idとユーザー名）を取得する
+# 毎リクエストで問い合わせないよう、有効期限つきでキャッシュする
+def load_user(user_id: int):
+    check_generations()
+    cache = current_app.extensions['flaskr_user_cache']
+    user = cache.get(user_id)
+    if user is None:
+        user = get_db().execute(
+            'SELECT id, username FROM user WHERE id = ?', (user_id,)
         ).fetchone()
+        if user is not None:
+            cache.set(user_id, user)
+    return user
+
+
+# キャッシュしているユーザー情報を捨てる
+# ユーザー情報を変更する処理ではコミットの前にこれを呼ぶ（他のプロセスのキャッシュからも捨てられる）
+def forget_user(user_id: int):
+    bump_generations(f'user:{user_id}')
+    current_app.extensions['flaskr_user_cache'].delete(user_id)
 
 
 # 他のviewでの認証の要求
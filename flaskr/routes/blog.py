@@ -1,58 +1,114 @@
-from flask import Blueprint, render_template, request, flash, g, redirect, url_for
+from datetime import datetime
+import re
+import sqlite3
+
+from flask import Blueprint, render_template, request, flash, g, redirect, url_for, current_app, make_response
+from markupsafe import Markup, escape
 from werkzeug.exceptions import abort
 
+from flaskr.cache import cached_page, commit_and_invalidate, invalidate_pages, make_etag, not_modified, set_validators
 from flaskr.db import get_db
+from flaskr.render import render_post, stream_template
 from flaskr.routes.auth import login_required
 
 bp = Blueprint('blog', __name__)
 
+# 検索結果のページ番号の上限（OFFSETが整数の範囲を超えないようにする）
+MAX_PAGE = 10000
+
+# カーソルの日時の書き方（保存されている形か 'T' 区切り、小数点以下の秒は任意）
+_CURSOR_CREATED = re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?')
+# 検索語から取り除く制御文字（NULなどはFTS5の構文エラーになる）
+_CONTROL_CHARS = dict.fromkeys([*range(0x20), 0x7f], ' ')
 
-# blog.index  /  ログインして最初に表示されるホーム
+
+# blog.index  /?before=<cursor> | /?after=<cursor>  ログインして最初に表示されるホーム
+# (created, id) をキーにしたカーソルでページ送りする
 @bp.get('/')
+@cached_page('list')
 def index():
-    db = get_db()
-    posts = db.execute(
-        'SELECT * FROM all_posts '
-        ' ORDER BY created DESC; '
-    ).fetchall()
-    return render_template('blog/index.html', posts=posts)
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after'))
+    posts, prev_cursor, next_cursor = get_posts_page(before=before, after=after)
+
+    # 表示する投稿とその版数が変わっていなければ描画せずに304を返す
+    etag = make_etag('index', prev_cursor, next_cursor,
+                     *(f"{post['id']}.{post['version']}" for post in posts))
+    if (response := not_modified(etag)) is not None:
+        return response
 
+    last_modified = max((post['updated'] or post['created'] for post in posts), default=None)
+    response = stream_template('blog/index.html', posts=posts,
+                               prev_cursor=prev_cursor, next_cursor=next_cursor)
+    return set_validators(response, etag, last_modified)
 
-# # blog.search   /search?author=value  一覧での作者の検索
+
+# blog.search   /search?q=value | /search?author=value  一覧での全文検索・作者の検索
 @bp.get('/search')
+@cached_page('list')
 def search():
-    '''一覧ページで作者名で記事を検索する'''
-    if (author := request.args.get('author')) is not None:
-        if author == '':
-            posts = []
-            flash('検索条件を指定してください')
-        else:
-            posts = get_db().execute(
-                'SELECT * FROM all_posts '
-                ' WHERE author_name LIKE ?;',
-                (f'%{author}%',)
-            ).fetchall()
-
-        return render_template('blog/search.html', posts=posts, author=author)
+    '''一覧ページで本文・タイトル・作者名の全文検索か、作者名で記事を検索する'''
+    q = request.args.get('q')
+    author = request.args.get('author')
+    if q is None and author is None:
+        return redirect(url_for('blog.index'))
 
-    return redirect(url_for('blog.index'))
+    page = min(max(request.args.get('page', 1, type=int), 1), MAX_PAGE)
+    if q:
+        posts, total = search_posts(q, page)
+    elif author:
+        posts, total = search_posts_by_author(author, page)
+    else:
+        posts, total = [], 0
+        flash('検索条件を指定してください')
+
+    # 全文検索で順位を付けるのは一致した中の新しい SEARCH_RANK_LIMIT 件までなので、
+    # ページ送りもそこまでにし、それより古い投稿は表示しないことを画面に出す
+    shown_total = min(total, current_app.config['SEARCH_RANK_LIMIT']) if q else total
+    # postsはカーソルのまま渡し、描画しながら1行ずつ読む
+    has_next = page * current_app.config['POSTS_PER_PAGE'] < shown_total
+    return stream_template('blog/search.html', posts=posts, total=total, shown_total=shown_total,
+                           q=q, author=author, page=page, has_next=has_next)
 
 
 # blog.article  /<int:id>  記事の詳細の表示
 @bp.get('/<int:id>')
+@cached_page('post:{id}')
 def article(id: int):
-    post = get_post(id, check_author=False)
-    comments = get_comments(id)
-    vote = get_vote(id)
-    vote_count = get_db().execute(
-        'SELECT agree, disagree '
-        ' FROM vote_count '
-        ' WHERE post_id = ?',
-        (id,)
-    ).fetchone()
-
-    return render_template('blog/article.html',
-                           post=post, comments=comments, vote=vote, vote_count=vote_count)
+    post = load_article(id)
+
+    # 記事の版数が変わっていなければコメントを取得せずに304を返す
+    etag = make_etag('article', id, post['version'])
+    if (response := not_modified(etag)) is not None:
+        return response
+
+    comments, next_cursor = get_comments(id)
+
+    response = make_response(render_template('blog/article.html', post=post,
+                                             comments=comments, next_cursor=next_cursor))
+    return set_validators(response, etag, post['updated'] or post['created'])
+
+
+# blog.comments  /<int:id>/comments?after=<cursor>  コメントの続きをJSONで返す
+@bp.get('/<int:id>/comments')
+@cached_page('post:{id}')
+def comments(id: int):
+    after = parse_cursor(request.args.get('after'))
+    comments, next_cursor = get_comments(id, after=after)
+    return {
+        'comments': [
+            {
+                'id': comment['id'],
+                'post_id': comment['post_id'],
+                'commenter_id': comment['commenter_id'],
+                'username': comment['username'],
+                'created': str(comment['created']),
+                'body': comment['body'],
+            }
+            for comment in comments
+        ],
+        'next': next_cursor,
+    }
 
 
 # blog.create /create 記事の作成　ログイン要
@@ -75,12 +131,14 @@ def create_post():
 
     if error is None:
         db = get_db()
+        body_html, excerpt = render_post(body)
         db.execute(
-            'INSERT INTO post (title, body, author_id)'
-            ' VALUES (?, ?, ?);',
-            (title, body, g.user['id'])
+            'INSERT INTO post (title, body, body_html, excerpt, author_id)'
+            ' VALUES (?, ?, ?, ?, ?);',
+            (title, body, body_html, excerpt, g.user['id'])
         )
-        db.commit()
+        invalidate_pages('list')
+        commit_and_invalidate()
         return redirect(url_for('blog.index'))
     else:
         flash(error)
@@ -109,12 +167,15 @@ def update_post(id: int):
 
     if error is None:
         db = get_db()
+        body_html, excerpt = render_post(body)
         db.execute(
-            'UPDATE post SET title = ?, body = ?'
+            'UPDATE post SET title = ?, body = ?, body_html = ?, excerpt = ?,'
+            ' version = version + 1, updated = CURRENT_TIMESTAMP'
             ' WHERE id = ?',
-            (title, body, id)
+            (title, body, body_html, excerpt, id)
         )
-        db.commit()
+        invalidate_pages('list', f'post:{id}')
+        commit_and_invalidate()
         return redirect(url_for('blog.article', id=id))
     else:
         flash(error)
@@ -128,11 +189,13 @@ def delete_post(id: int):
     # アクセスが投稿者かどうか確認する（投稿者でなければ403）
     get_post(id)
     db = get_db()
+    # コメント・投票は外部キーの ON DELETE CASCADE で一緒に消える
     db.execute(
         'DELETE FROM post WHERE id = ?',
         (id,)
     )
-    db.commit()
+    invalidate_pages('list', f'post:{id}')
+    commit_and_invalidate()
     return redirect(url_for('blog.index'))
 
 
@@ -152,12 +215,17 @@ def comment_create_post(id: int):
 
     if error is None:
         db = get_db()
-        db.execute(
-            'INSERT INTO comment (post_id, commenter_id, body) '
-            ' VALUES (?, ?, ?);',
-            (id, g.user['id'], body)
-        )
-        db.commit()
+        try:
+            db.execute(
+                'INSERT INTO comment (post_id, commenter_id, body) '
+                ' VALUES (?, ?, ?);',
+                (id, g.user['id'], body)
+            )
+        except sqlite3.IntegrityError:
+            # 外部キーの制約により、存在しない記事にはコメントできない
+            abort(404, f'Post id {id} doesn\'t exist.')
+        invalidate_pages('list', f'post:{id}')
+        commit_and_invalidate()
         return redirect(url_for('blog.article', id=id))
     else:
         flash(error)
@@ -190,7 +258,8 @@ def comment_delete_post(id: int):
             'DELETE FROM comment WHERE id = ?;',
             (comment_id,)
         )
-        db.commit()
+        invalidate_pages('list', f'post:{id}')
+        commit_and_invalidate()
         return redirect(url_for('blog.article', id=id))
     else:
         flash(error)
@@ -200,24 +269,33 @@ def comment_delete_post(id: int):
 @bp.post('/<int:id>/vote')
 @login_required
 def vote_post(id: int):
-    """投票をデータベースに登録する"""
+    """投票をデータベースに登録する（投票済なら賛成・反対を切り替える）"""
     intention = request.form['intention']
-    vote = get_vote(id)
     error = None
 
     # バリデーション
-    if vote is not None:
-        error = 'you are already vote.'
     if intention not in ('0', '1'):
         error = 'illegal value.'
+    else:
+        # 投票・切り替えを1文で行う　同じ意見に投票済なら何も変わらない
+        db = get_db()
+        try:
+            cur = db.execute(
+                'INSERT INTO vote (post_id, user_id, intention) VALUES (?, ?, ?)'
+                ' ON CONFLICT (post_id, user_id) DO UPDATE'
+                ' SET intention = excluded.intention'
+                ' WHERE intention != excluded.intention;',
+                (id, g.user['id'], int(intention))
+            )
+        except sqlite3.IntegrityError:
+            # 外部キーの制約により、存在しない記事には投票できない
+            abort(404, f'Post id {id} doesn\'t exist.')
+        if cur.rowcount == 0:
+            error = 'you are already vote.'
 
     if error is None:
-        db = get_db()
-        db.execute(
-            'INSERT INTO vote (post_id, user_id, intention) VALUES (?, ?, ?);',
-            (id, g.user['id'], int(intention))
-        )
-        db.commit()
+        invalidate_pages('list', f'post:{id}')
+        commit_and_invalidate()
         return redirect(url_for('blog.article', id=id))
     else:
         flash(error)
@@ -228,19 +306,19 @@ def vote_post(id: int):
 @login_required
 def vote_cancel_post(id: int):
     """投票を取り消す（DBから削除する）"""
-    vote = get_vote(id)
+    db = get_db()
+    cur = db.execute(
+        'DELETE FROM vote WHERE post_id = ? AND user_id = ?',
+        (id, g.user['id'])
+    )
     error = None
 
-    if vote is None:
+    if cur.rowcount == 0:
         error = 'you are not vote.'
 
     if error is None:
-        db = get_db()
-        db.execute(
-            'DELETE FROM vote WHERE post_id = ? AND user_id = ?',
-            (id, g.user['id'])
-        ).fetchone()
-        db.commit()
+        invalidate_pages('list', f'post:{id}')
+        commit_and_invalidate()
         return redirect(url_for('blog.article', id=id))
     else:
         flash(error)
@@ -264,31 +342,226 @@ def get_post(id: int, check_author: bool = True):
     return post
 
 
-def get_comments(post_id: int) -> list:
-    """指定したidの投稿へのコメントを新しい順で取得する"""
+def load_article(id: int):
+    """記事の詳細ページに必要な投稿・投稿者名・投票数・ログインユーザーの投票を1回の問い合わせで取得する
+
+    ログインユーザーの投票は vote（賛成1・反対0・未投票None）に入る
+    """
+    user_id = g.user['id'] if g.user is not None else None
+    post = get_db().execute(
+        'SELECT p.id, p.title, p.body, p.body_html, p.created, p.updated, p.version,'
+        ' p.author_id, u.username, p.comment_count, p.agree, p.disagree,'
+        ' v.intention AS vote'
+        ' FROM post AS p'
+        ' INNER JOIN user AS u ON p.author_id = u.id'
+        ' LEFT OUTER JOIN vote AS v ON v.post_id = p.id AND v.user_id = ?'
+        ' WHERE p.id = ?',
+        (user_id, id)
+    ).fetchone()
+    if post is None:
+        abort(404, f'Post id {id} doesn\'t exist.')
+
+    return post
+
+
+def get_comments(post_id: int, after=None):
+    """指定したidの投稿へのコメントを新しい順で1ページ分取得する
+
+    (created, id) のカーソルより古いものを comment_post_idx の範囲検索で取り出す。
+    (comments, 次のページのカーソル) を返す
+    """
+    per_page = current_app.config['COMMENTS_PER_PAGE']
+    where, params = ' WHERE c.post_id = ? ', [post_id]
+    if after is not None:
+        where += ' AND (c.created, c.id) < (?, ?) '
+        params.extend(after)
 
     comments = get_db().execute(
-        'SELECT c.id, c.post_id, c.commenter_id, c.created, c.body, u.username '
+        'SELECT c.id, c.post_id, c.commenter_id, c.created, c.body, u.username,'
+        ' CAST(c.created AS TEXT) AS cursor_created '
         ' FROM comment AS c '
         ' INNER JOIN user AS u '
         ' ON c.commenter_id = u.id '
-        ' WHERE c.post_id = ? '
-        ' ORDER BY c.created DESC; ',
-        (post_id,)
+        + where +
+        ' ORDER BY c.created DESC, c.id DESC '
+        ' LIMIT ?; ',
+        (*params, per_page + 1)
     ).fetchall()
 
-    return comments
+    next_cursor = make_cursor(comments[per_page - 1]) if len(comments) > per_page else None
+    return comments[:per_page], next_cursor
+
 
+def make_cursor(post) -> str:
+    """一覧のページ送り用のカーソル文字列を投稿から作る
 
-def get_vote(post_id: int):
-    """指定したidの投稿への投票を取得する"""
-    if g.user is None:
+    createdは変換したdatetimeではなく、保存されている文字列（cursor_created）のまま使う
+    （小数点以下の秒の書き方が変わると、文字列で比べたときに行を飛ばしたり繰り返したりする）
+    """
+    return f"{post['cursor_created']}_{post['id']}"
+
+
+def parse_cursor(cursor):
+    """カーソル文字列を (created, id) に戻す　不正な値は400
+
+    createdは保存されている形の文字列のまま（小数点以下の秒も残す）で返し、'T' 区切りだけ空白にそろえる
+    """
+    if cursor is None:
         return None
 
-    vote = get_db().execute(
-        'SELECT * FROM vote '
-        ' WHERE post_id = ? AND user_id = ?',
-        (post_id, g.user['id'])
-    ).fetchone()
+    created, _, id = cursor.rpartition('_')
+    if _CURSOR_CREATED.fullmatch(created) is None:
+        abort(400, f'Invalid cursor {cursor}.')
+    created = created.replace('T', ' ', 1)
+    try:
+        datetime.fromisoformat(created)
+        id = int(id)
+    except ValueError:
+        abort(400, f'Invalid cursor {cursor}.')
+    # idはSQLiteの整数の範囲内でなければ渡せない
+    if not 1 <= id <= 2 ** 63 - 1:
+        abort(400, f'Invalid cursor {cursor}.')
+    return created, id
+
+
+def get_posts_page(before=None, after=None):
+    """投稿一覧の1ページ分を新しい順で取得する
+
+    OFFSETを使わず (created, id) の範囲検索でページを切り出すので、
+    どのページでもインデックスを先頭から読むのと同じコストで済む。
+    (posts, 前のページのカーソル, 次のページのカーソル) を返す
+    """
+    per_page = current_app.config['POSTS_PER_PAGE']
+    db = get_db()
+
+    if after is not None:
+        # より新しい側のページ　昇順に取ってから並べ直す
+        posts = db.execute(
+            'SELECT *, CAST(created AS TEXT) AS cursor_created FROM all_posts '
+            ' WHERE (created, id) > (?, ?) '
+            ' ORDER BY created, id '
+            ' LIMIT ?; ',
+            (*after, per_page + 1)
+        ).fetchall()
+        if len(posts) <= per_page:
+            # 先頭まで戻ったので1ページ目を表示する
+            return get_posts_page()
+        posts = posts[per_page - 1::-1]
+        has_prev, has_next = True, True
+    elif before is not None:
+        posts = db.execute(
+            'SELECT *, CAST(created AS TEXT) AS cursor_created FROM all_posts '
+            ' WHERE (created, id) < (?, ?) '
+            ' ORDER BY created DESC, id DESC '
+            ' LIMIT ?; ',
+            (*before, per_page + 1)
+        ).fetchall()
+        has_prev, has_next = True, len(posts) > per_page
+        posts = posts[:per_page]
+    else:
+        posts = db.execute(
+            'SELECT *, CAST(created AS TEXT) AS cursor_created FROM all_posts '
+            ' ORDER BY created DESC, id DESC '
+            ' LIMIT ?; ',
+            (per_page + 1,)
+        ).fetchall()
+        has_prev, has_next = False, len(posts) > per_page
+        posts = posts[:per_page]
+
+    prev_cursor = make_cursor(posts[0]) if has_prev and posts else None
+    next_cursor = make_cursor(posts[-1]) if has_next and posts else None
+    return posts, prev_cursor, next_cursor
+
+
+def make_match_query(q: str):
+    """入力された検索語をFTS5のMATCH式にする
+
+    語ごとにフレーズとして引用するので、FTS5の演算子や記号はそのまま検索語になる。
+    制御文字は空白として扱う。検索語がなければNoneを返す
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in q.translate(_CONTROL_CHARS).split()]
+    return ' '.join(terms) or None
+
+
+def highlight(snippet: str) -> Markup:
+    """snippet()の区切り文字を<mark>にしてHTMLとして返す（本文はエスケープする）"""
+    return Markup(
+        str(escape(snippet)).replace('\x02', '<mark>').replace('\x03', '</mark>')
+    )
+
+
+def search_posts(q: str, page: int):
+    """post_ftsを全文検索してbm25の順位で1ページ分の投稿（を読み出すイテレータ）と総件数を返す
+
+    bm25は順位を付ける行ごとに計算するので、一致した中の新しい SEARCH_RANK_LIMIT 件だけに
+    順位を付ける（よくある語でも1ページの時間が一致した件数に比例しない）。
+    ページ送りもその範囲まで
+    """
+    match = make_match_query(q)
+    if match is None:
+        return [], 0
+
+    per_page = current_app.config['POSTS_PER_PAGE']
+    db = get_db()
+    try:
+        total = db.execute(
+            'SELECT count(*) FROM post_fts WHERE post_fts MATCH ?;',
+            (match,)
+        ).fetchone()[0]
+        # 順位を付けた1ページ分のrowidを先に決め、その行だけsnippetを作る
+        rows = db.execute(
+            'WITH ranked AS ('
+            '  SELECT rowid, score FROM ('
+            '   SELECT rowid, bm25(post_fts) AS score FROM post_fts '
+            '    WHERE post_fts MATCH ? '
+            '    ORDER BY rowid DESC LIMIT ?) '
+            '  ORDER BY score LIMIT ? OFFSET ?) '
+            'SELECT p.*, snippet(post_fts, -1, char(2), char(3), \'…\', 16) AS snippet '
+            ' FROM ranked '
+            ' CROSS JOIN post_fts ON post_fts.rowid = ranked.rowid '
+            ' INNER JOIN all_posts AS p '
+            ' ON p.id = ranked.rowid '
+            ' WHERE post_fts MATCH ? '
+            ' ORDER BY ranked.score; ',
+            (match, current_app.config['SEARCH_RANK_LIMIT'],
+             per_page, (page - 1) * per_page, match)
+        )
+    except sqlite3.OperationalError:
+        # 引用してもFTS5が受け付けない検索語は、一致なしとして扱う
+        return [], 0
+
+    # fetchallせず、読み出すたびに1行ずつ変換する
+    posts = (dict(row, snippet=highlight(row['snippet'])) for row in rows)
+    return posts, total
+
+
+def search_posts_by_author(author: str, page: int):
+    """作者名の前方一致で1ページ分の投稿（新しい順、カーソルのまま）と総件数を返す
+
+    GLOBの前方一致はuserのusernameの索引で範囲検索できる（LIKE '%…%' は全件を読む）。
+    """
+    per_page = current_app.config['POSTS_PER_PAGE']
+    pattern = make_prefix_glob(author)
+    db = get_db()
+    total = db.execute(
+        'SELECT count(*) FROM post '
+        ' WHERE author_id IN (SELECT id FROM user WHERE username GLOB ?);',
+        (pattern,)
+    ).fetchone()[0]
+    # 並べ替えはpost_author_created_idxの (created, id) だけで行い、1ページ分の行だけを読む
+    posts = db.execute(
+        'SELECT * FROM all_posts '
+        ' WHERE id IN ('
+        '  SELECT id FROM post '
+        '   WHERE author_id IN (SELECT id FROM user WHERE username GLOB ?) '
+        '   ORDER BY created DESC, id DESC '
+        '   LIMIT ? OFFSET ?) '
+        ' ORDER BY created DESC, id DESC; ',
+        (pattern, per_page, (page - 1) * per_page)
+    )
+    return posts, total
+
 
-    return vote
+def make_prefix_glob(prefix: str) -> str:
+    """prefixで始まる文字列に一致するGLOBのパターン（GLOBの記号は [] で囲んで文字として扱う）"""
+    return re.sub(r'([*?\[])', r'[\1]', prefix) + '*'
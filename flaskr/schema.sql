@@ -1,7 +1,10 @@
-DROP TABLE IF EXISTS user;
-DROP TABLE IF EXISTS post;
-DROP TABLE IF EXISTS comment;
+-- 外部キーが有効でも消せるよう、参照する側の表から消す
 DROP TABLE IF EXISTS vote;
+DROP TABLE IF EXISTS comment;
+DROP TABLE IF EXISTS post;
+DROP TABLE IF EXISTS user;
+DROP TABLE IF EXISTS post_fts;
+DROP TABLE IF EXISTS cache_generation;
 DROP VIEW IF EXISTS vote_count;
 DROP VIEW IF EXISTS comment_count;
 DROP VIEW IF EXISTS all_posts;
@@ -19,6 +22,17 @@ CREATE TABLE post (
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   title TEXT NOT NULL,
   body TEXT NOT NULL,
+  -- 作成・更新時に変換した本文のHTMLと一覧用の抜粋
+  body_html TEXT,
+  excerpt TEXT,
+  -- コメント数・投票数（comment, vote のトリガーで更新する）
+  comment_count INTEGER NOT NULL DEFAULT 0,
+  agree INTEGER NOT NULL DEFAULT 0,
+  disagree INTEGER NOT NULL DEFAULT 0,
+  -- 表示が変わる書き込み（本文の更新・コメント・投票）のたびに進める版数と日時
+  -- updatedがNULLなら作成してから変わっていない
+  version INTEGER NOT NULL DEFAULT 1,
+  updated TIMESTAMP,
   FOREIGN KEY (author_id) REFERENCES user (id)
 );
 
@@ -28,58 +42,146 @@ CREATE TABLE comment (
   commenter_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   body TEXT NOT NULL,
-  FOREIGN KEY (post_id) REFERENCES post (id),
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE,
   FOREIGN KEY (commenter_id) REFERENCES user (id)
 );
 
+-- 1人1記事に1票なので (post_id, user_id) を主キーにする
 CREATE TABLE vote (
   post_id INTEGER NOT NULL,
   user_id INTEGER NOT NULL,
   intention INTEGER NOT NULL,
-  FOREIGN KEY (post_id) REFERENCES post (id),
+  PRIMARY KEY (post_id, user_id),
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE,
   FOREIGN KEY (user_id) REFERENCES user (id)
+) WITHOUT ROWID;
+
+
+-- プロセスごとのキャッシュを無効にするための、名前空間（'list', 'post:<id>', 'user:<id>'）ごとの世代
+-- 世代はすべての名前空間で通しの番号にし、前回より後に進んだ名前空間だけを索引で読めるようにする
+CREATE TABLE cache_generation (
+  namespace TEXT PRIMARY KEY,
+  generation INTEGER NOT NULL
+) WITHOUT ROWID;
+
+
+-- 全文検索
+-- タイトル・本文・作者名の索引（中身はall_postsビューを参照する）
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, author_name,
+  content = 'all_posts', content_rowid = 'id',
+  tokenize = 'unicode61 remove_diacritics 2'
 );
 
 
--- ビュー定義
--- 投稿ごとのコメント数
-CREATE VIEW comment_count (post_id, cnt)
-AS
-  SELECT
-    post_id,
-    count(*)
-  FROM comment
-  GROUP BY post_id
-;
+-- インデックス定義
+-- 一覧のページ送り (created, id) 用
+CREATE INDEX post_created_idx ON post (created, id);
+-- 作者名での検索（新しい順）用
+CREATE INDEX post_author_created_idx ON post (author_id, created, id);
+-- 記事ごとのコメント一覧用
+CREATE INDEX comment_post_idx ON comment (post_id, created);
+CREATE INDEX comment_commenter_idx ON comment (commenter_id);
+CREATE INDEX cache_generation_idx ON cache_generation (generation);
 
--- 投稿ごとの投票数
-CREATE VIEW vote_count (post_id, agree, disagree)
-AS
-  SELECT
-    post_id,
-    SUM(CASE WHEN intention = 1 THEN 1 ELSE 0 END),
-    SUM(CASE WHEN intention = 0 THEN 1 ELSE 0 END)
-  FROM vote
-  GROUP BY post_id
-;
 
+-- トリガー定義
+-- コメント数の更新
+CREATE TRIGGER comment_count_insert AFTER INSERT ON comment
+BEGIN
+  UPDATE post
+    SET comment_count = comment_count + 1,
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER comment_count_delete AFTER DELETE ON comment
+BEGIN
+  UPDATE post
+    SET comment_count = comment_count - 1,
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+-- 投票数の更新
+CREATE TRIGGER vote_count_insert AFTER INSERT ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER vote_count_delete AFTER DELETE ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER vote_count_update AFTER UPDATE OF post_id, intention ON vote
+BEGIN
+  UPDATE post
+    SET agree = agree - (OLD.intention = 1),
+        disagree = disagree - (OLD.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = OLD.post_id;
+  UPDATE post
+    SET agree = agree + (NEW.intention = 1),
+        disagree = disagree + (NEW.intention = 0),
+        version = version + 1, updated = CURRENT_TIMESTAMP
+    WHERE id = NEW.post_id;
+END;
+
+-- 全文検索の索引の更新
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post
+BEGIN
+  INSERT INTO post_fts (rowid, title, body, author_name)
+    SELECT NEW.id, NEW.title, NEW.body, username FROM user WHERE id = NEW.author_id;
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body, author_name)
+    SELECT 'delete', OLD.id, OLD.title, OLD.body, username FROM user WHERE id = OLD.author_id;
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body, author_id ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body, author_name)
+    SELECT 'delete', OLD.id, OLD.title, OLD.body, username FROM user WHERE id = OLD.author_id;
+  INSERT INTO post_fts (rowid, title, body, author_name)
+    SELECT NEW.id, NEW.title, NEW.body, username FROM user WHERE id = NEW.author_id;
+END;
+
+CREATE TRIGGER post_fts_user_update AFTER UPDATE OF username ON user
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body, author_name)
+    SELECT 'delete', id, title, body, OLD.username FROM post WHERE author_id = OLD.id;
+  INSERT INTO post_fts (rowid, title, body, author_name)
+    SELECT id, title, body, NEW.username FROM post WHERE author_id = NEW.id;
+END;
+
+
+-- ビュー定義
 -- 投稿＋投稿者名＋コメント数＋投票数 の一覧
 CREATE VIEW all_posts 
-  (id, title, body, created, author_id, 
+  (id, title, body, excerpt, created, author_id, 
   author_name, 
   comment_count, 
-  agree, disagree)
+  agree, disagree,
+  version, updated)
 AS
   SELECT
-    p.id, p.title, p.body, p.created, p.author_id,
+    p.id, p.title, p.body, p.excerpt, p.created, p.author_id,
     u.username,
-    c.cnt,
-    v.agree, v.disagree
+    p.comment_count,
+    p.agree, p.disagree,
+    p.version, p.updated
   FROM post AS p
     INNER JOIN user AS u 
       ON p.author_id = u.id
-    LEFT OUTER JOIN comment_count AS c
-      ON p.id = c.post_id
-    LEFT OUTER JOIN vote_count AS v 
-      ON p.id = v.post_id
 ;
@@ -0,0 +1,217 @@
+import random
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+
+from flaskr.db import get_db
+
+
+# 合成データの本文に使う単語
+# markdownの記法を含まない単語だけなので、本文のHTMLは<p>で囲むだけで作れる
+WORDS = ('flask', 'sqlite', 'python', 'jinja', 'index', 'query', 'cache', 'page',
+         'vote', 'comment', 'search', 'markdown', 'server', 'worker', 'latency')
+
+# 投入する表（索引・トリガーを投入中だけ外す）
+TABLES = ('user', 'post', 'comment', 'vote')
+
+# 投入する投稿の作成日時の起点（1件ごとに1分ずつ進める）
+START = datetime(2020, 1, 1)
+
+# 投入中に使うページキャッシュの大きさ（KiB）
+SEED_CACHE_KIB = 256 * 1024
+
+
+def _drop_indexes_and_triggers(db):
+    """投入する表の索引・トリガーを1つのトランザクションで外し、作り直すためのSQLを返す"""
+    placeholders = ', '.join('?' * len(TABLES))
+    objects = db.execute(
+        'SELECT type, name, sql FROM sqlite_master'
+        f" WHERE type IN ('index', 'trigger') AND sql IS NOT NULL AND tbl_name IN ({placeholders})",
+        TABLES
+    ).fetchall()
+    db.execute('BEGIN')
+    try:
+        for obj in objects:
+            db.execute(f'DROP {obj["type"].upper()} "{obj["name"]}"')
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return [obj['sql'] for obj in objects]
+
+
+def _restore_indexes_and_triggers(db, schema, rebuild_fts: bool):
+    """外した索引・トリガーを作り直し、必要なら全文検索の索引も作り直す"""
+    db.execute('BEGIN')
+    try:
+        for sql in schema:
+            db.execute(sql)
+        if rebuild_fts:
+            # 作り直しの途中でセグメントを併合しないようにし、終わったら既定値に戻す
+            db.execute("INSERT INTO post_fts (post_fts, rank) VALUES ('automerge', 0)")
+            db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+            db.execute("INSERT INTO post_fts (post_fts, rank) VALUES ('automerge', 4)")
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def _posts(rng, users: range, first_id: int, count: int, comments_per_post: int,
+           votes_per_post: int, texts):
+    """投稿とそのコメント・投票の行を作る　コメント数・投票数は投稿の行に入れておく
+
+    乱数は rng.choices でバッチ分をまとめて引く（1行ずつ rng.choice を呼ぶより数倍速い）
+    """
+    titles, bodies, comment_bodies = texts
+    post_ids = range(first_id, first_id + count)
+    stamps = [(START + timedelta(minutes=post_id)).isoformat(' ') for post_id in post_ids]
+    # 投票者は重ならないように連続したidを選ぶ
+    offsets = rng.choices(range(len(users)), k=count)
+    voters = [[users[(offset + n) % len(users)] for n in range(votes_per_post)]
+              for offset in offsets]
+    intentions = [[(bits >> n) & 1 for n in range(votes_per_post)]
+                  for bits in (rng.getrandbits(votes_per_post) if votes_per_post else 0
+                               for _ in post_ids)]
+
+    posts = [
+        (post_id, author_id, stamp, title, *body,
+         comments_per_post, sum(intention), votes_per_post - sum(intention))
+        for post_id, author_id, stamp, title, body, intention in zip(
+            post_ids, rng.choices(users, k=count), stamps, rng.choices(titles, k=count),
+            rng.choices(bodies, k=count), intentions
+        )
+    ]
+    # コメントは投稿の1秒後から1秒ずつずらす（1投稿あたり59件まで）
+    comments = list(zip(
+        [post_id for post_id in post_ids for _ in range(comments_per_post)],
+        rng.choices(users, k=count * comments_per_post),
+        [f'{stamp[:-2]}{n:02d}' for stamp in stamps for n in range(1, comments_per_post + 1)],
+        rng.choices(comment_bodies, k=count * comments_per_post),
+    ))
+    votes = [
+        (post_id, user_id, intention)
+        for post_id, post_voters, post_intentions in zip(post_ids, voters, intentions)
+        for user_id, intention in zip(post_voters, post_intentions)
+    ]
+    return posts, comments, votes
+
+
+def _texts(rng, size: int = 4096):
+    """タイトル・本文（HTMLと抜粋つき）・コメントの候補を作る"""
+    titles = [' '.join(rng.choices(WORDS, k=4)) for _ in range(size)]
+    bodies = []
+    for _ in range(size):
+        body = ' '.join(rng.choices(WORDS, k=40))
+        bodies.append((body, f'<p>{body}</p>\n', ' '.join(body[:30].split()) + ' ...'))
+    comment_bodies = [' '.join(rng.choices(WORDS, k=5)) for _ in range(size)]
+    return titles, bodies, comment_bodies
+
+
+def seed(users: int, posts: int, comments_per_post: int = 3, votes_per_post: int = 5,
+         seed: int = 0, batch_size: int = 50000, password: str = 'password'):
+    """合成データをまとめて投入する
+
+    同じシードなら同じデータになる。投入中は同期書き込みを止め、索引とトリガーを外して
+    executemanyでバッチごとに1トランザクションで入れ、最後に索引・トリガー・全文検索の索引を作り直す。
+    途中で止まったときも（それまでにコミットしたバッチは残したまま）索引・トリガーは作り直す。
+    進み具合として投入済みの投稿数を yield する
+    """
+    if votes_per_post > users:
+        raise ValueError('votes_per_post must not exceed users.')
+    if comments_per_post > 59:
+        raise ValueError('comments_per_post must not exceed 59.')
+
+    rng = random.Random(seed)
+    texts = _texts(rng)
+    db = get_db()
+    synchronous = db.execute('PRAGMA synchronous').fetchone()[0]
+    cache_size = db.execute('PRAGMA cache_size').fetchone()[0]
+    foreign_keys = db.execute('PRAGMA foreign_keys').fetchone()[0]
+    temp_store = db.execute('PRAGMA temp_store').fetchone()[0]
+    db.execute('PRAGMA synchronous = OFF')
+    # 作るデータの参照先は必ずあるので、行ごとの外部キーの確認を省く
+    db.execute('PRAGMA foreign_keys = OFF')
+    db.execute('PRAGMA temp_store = MEMORY')
+    # 索引の作り直しが並べ替えをメモリ上で済ませられるようにページキャッシュを広げる
+    db.execute(f'PRAGMA cache_size = {-SEED_CACHE_KIB}')
+
+    schema = []
+    inserted = False
+    try:
+        schema = _drop_indexes_and_triggers(db)
+
+        # 既存のデータの後ろに追加する
+        first_user = db.execute('SELECT coalesce(max(id), 0) + 1 FROM user').fetchone()[0]
+        first_post = db.execute('SELECT coalesce(max(id), 0) + 1 FROM post').fetchone()[0]
+        user_ids = range(first_user, first_user + users)
+        pwhash = generate_password_hash(password, current_app.config['PASSWORD_HASH_METHOD'])
+        db.executemany(
+            'INSERT INTO user (id, username, password) VALUES (?, ?, ?)',
+            ((user_id, f'user{user_id}', pwhash) for user_id in user_ids)
+        )
+        db.commit()
+        inserted = True
+
+        done = 0
+        while done < posts:
+            count = min(batch_size, posts - done)
+            post_rows, comment_rows, vote_rows = _posts(
+                rng, user_ids, first_post + done, count, comments_per_post, votes_per_post,
+                texts
+            )
+            db.executemany(
+                'INSERT INTO post (id, author_id, created, title, body, body_html, excerpt,'
+                ' comment_count, agree, disagree) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                post_rows
+            )
+            db.executemany(
+                'INSERT INTO comment (post_id, commenter_id, created, body) VALUES (?, ?, ?, ?)',
+                comment_rows
+            )
+            db.executemany(
+                'INSERT INTO vote (post_id, user_id, intention) VALUES (?, ?, ?)',
+                vote_rows
+            )
+            db.commit()
+            done += count
+            yield done
+    finally:
+        # 途中で止まっても（^Cを含む）索引・トリガーのないデータベースを残さない
+        db.rollback()
+        try:
+            _restore_indexes_and_triggers(db, schema, rebuild_fts=inserted)
+        finally:
+            db.execute(f'PRAGMA synchronous = {synchronous}')
+            db.execute(f'PRAGMA cache_size = {cache_size}')
+            db.execute(f'PRAGMA foreign_keys = {foreign_keys}')
+            db.execute(f'PRAGMA temp_store = {temp_store}')
+
+    db.execute('ANALYZE')
+    db.commit()
+
+
+# 合成データを投入するカスタムコマンド
+@click.command('seed')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=10000, show_default=True)
+@click.option('--comments-per-post', default=3, show_default=True)
+@click.option('--votes-per-post', default=5, show_default=True)
+@click.option('--seed', 'seed_', default=0, show_default=True, help='Random seed.')
+@click.option('--batch-size', default=50000, show_default=True,
+              help='Posts inserted per transaction.')
+@with_appcontext
+def seed_command(users, posts, comments_per_post, votes_per_post, seed_, batch_size):
+    begin = time.perf_counter()
+    for done in seed(users, posts, comments_per_post, votes_per_post, seed_, batch_size):
+        click.echo(f'Inserted {done}/{posts} posts ({time.perf_counter() - begin:.1f}s)')
+    click.echo(f'Seeded {users} users, {posts} posts, {posts * comments_per_post} comments'
+               f' and {posts * votes_per_post} votes in {time.perf_counter() - begin:.1f}s.')
+
+
+def init_app(app):
+    app.cli.add_command(seed_command)
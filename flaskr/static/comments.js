@@ -0,0 +1,42 @@
+// 記事の詳細ページのコメントの続きを /<id>/comments?after= のJSONから読み込む
+(function () {
+  const container = document.getElementById('comments');
+  const more = document.getElementById('more-comments');
+  const userId = container.dataset.userId;
+
+  function render(comment) {
+    const div = document.createElement('div');
+    div.className = 'comment-body';
+    div.textContent = `${comment.body} : ${comment.created} : ${comment.username} : `;
+
+    if (String(comment.commenter_id) === userId) {
+      const form = document.createElement('form');
+      form.action = `/${comment.post_id}/comment/delete`;
+      form.method = 'post';
+      const button = document.createElement('button');
+      button.type = 'submit';
+      button.name = 'comment_id';
+      button.value = comment.id;
+      button.textContent = '削除';
+      button.onclick = () => confirm('Are you sure?');
+      form.appendChild(button);
+      div.appendChild(form);
+    }
+    return div;
+  }
+
+  more.addEventListener('click', async (event) => {
+    event.preventDefault();
+    const res = await fetch(more.href, { headers: { Accept: 'application/json' } });
+    const data = await res.json();
+    data.comments.forEach((comment) => container.appendChild(render(comment)));
+
+    if (data.next) {
+      const url = new URL(more.href);
+      url.searchParams.set('after', data.next);
+      more.href = url;
+    } else {
+      more.remove();
+    }
+  });
+})();
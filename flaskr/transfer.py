@@ -0,0 +1,209 @@
+import gzip
+import json
+import sqlite3
+import sys
+
+import click
+from flask.cli import with_appcontext
+
+from flaskr.db import get_db
+
+
+# 書き出す表と並べる順番のキー（読み込みもこの順で行うので、参照される側の表から並べる）
+TABLES = {
+    'user': ('id',),
+    'post': ('id',),
+    'comment': ('id',),
+    'vote': ('post_id', 'user_id'),
+}
+
+GZIP_MAGIC = b'\x1f\x8b'
+# 圧縮の度合い（既定の9は6と大きさがほとんど変わらず、数倍遅い）
+GZIP_LEVEL = 6
+
+# json.dumpsは引数を付けると呼ぶたびにエンコーダを作るので、1つを使い回す
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+# 読み込み中だけ外すトリガーの表（投稿の行に入っているカウンタを二重に数えないため）
+COUNTER_TABLES = ('comment', 'vote')
+
+
+def _columns(db, table: str) -> dict:
+    """表の列名と型"""
+    return {row['name']: row['type'] for row in db.execute(f'PRAGMA table_info("{table}")')}
+
+
+def open_output(path: str, compress: bool):
+    """書き出し先を開く　'-' は標準出力"""
+    if path == '-':
+        if compress:
+            return gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb', compresslevel=GZIP_LEVEL)
+        return sys.stdout.buffer
+    return gzip.open(path, 'wb', GZIP_LEVEL) if compress else open(path, 'wb')
+
+
+def open_input(path: str):
+    """読み込み元を開く　'-' は標準入力で、gzipかどうかは先頭のバイトで判断する"""
+    if path == '-':
+        stream = sys.stdin.buffer
+        return gzip.GzipFile(fileobj=stream, mode='rb') if stream.peek(2)[:2] == GZIP_MAGIC else stream
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == GZIP_MAGIC
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+def export_rows(tables=tuple(TABLES)):
+    """表の行を (表, 行の辞書) の形で順に返す
+
+    1つの読み取りトランザクションの中で読むので、途中で書き込みがあっても表どうしの整合はとれている。
+    fetchallせずカーソルを回すので、表の大きさによらずメモリは一定
+    """
+    db = get_db()
+    db.execute('BEGIN')
+    try:
+        for table in tables:
+            # 日時の列は変換せず、保存されている文字列のまま書き出す
+            columns = _columns(db, table)
+            select = ', '.join(
+                f'CAST("{name}" AS TEXT) AS "{name}"' if type_ == 'TIMESTAMP' else f'"{name}"'
+                for name, type_ in columns.items()
+            )
+            order = ', '.join(TABLES[table])
+            cursor = db.execute(f'SELECT {select} FROM "{table}" ORDER BY {order}')
+            cursor.arraysize = 1000
+            for row in cursor:
+                yield table, dict(zip(columns, row))
+    finally:
+        db.rollback()
+
+
+def export_data(stream, tables=tuple(TABLES)) -> dict:
+    """行を1行1つのJSON（NDJSON）で書き出し、表ごとの件数を返す"""
+    counts = dict.fromkeys(tables, 0)
+    for table, row in export_rows(tables):
+        stream.write((_encoder.encode({'table': table, 'row': row}) + '\n').encode('utf-8'))
+        counts[table] += 1
+    return counts
+
+
+def _last_keys(db) -> dict:
+    """表ごとに、すでに入っている行のうち最後のキー"""
+    keys = {}
+    for table, key in TABLES.items():
+        order = ', '.join(f'{column} DESC' for column in key)
+        row = db.execute(
+            f'SELECT {", ".join(key)} FROM "{table}" ORDER BY {order} LIMIT 1').fetchone()
+        keys[table] = tuple(row) if row is not None else None
+    return keys
+
+
+def import_data(stream, batch_size: int = 10000, resume: bool = False):
+    """NDJSONを読み込んで表に入れ、batch_size 件ごとにそれまでの表ごとの件数を返す
+
+    batch_size 件ごとに1トランザクションでコミットする。コメント・投票のカウンタのトリガーは
+    トランザクションの中で外して戻すので、途中で止まってもトリガーが消えたままになることはない。
+    resume が真なら、各表ですでに入っている最後のキー以下の行を飛ばして途中から再開する
+    """
+    db = get_db()
+    columns = {table: _columns(db, table) for table in TABLES}
+    last_keys = _last_keys(db) if resume else {}
+    triggers = db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"
+        f" AND tbl_name IN ({', '.join('?' * len(COUNTER_TABLES))})", COUNTER_TABLES
+    ).fetchall()
+    statements = {}
+    batch = []
+    counts = dict.fromkeys(TABLES, 0)
+
+    def flush():
+        db.execute('BEGIN')
+        try:
+            for trigger in triggers:
+                db.execute(f'DROP TRIGGER "{trigger["name"]}"')
+            for sql, values in batch:
+                db.execute(sql, values)
+            for trigger in triggers:
+                db.execute(trigger['sql'])
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        batch.clear()
+
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        table, row = record['table'], record['row']
+        if table not in TABLES:
+            raise ValueError(f'line {number}: unknown table {table!r}.')
+        if resume and last_keys[table] is not None and \
+                tuple(row[column] for column in TABLES[table]) <= last_keys[table]:
+            continue
+
+        names = tuple(row)
+        sql = statements.get((table, names))
+        if sql is None:
+            unknown = set(names) - set(columns[table])
+            if unknown:
+                raise ValueError(f'line {number}: unknown columns {sorted(unknown)} in {table}.')
+            sql = statements[(table, names)] = (
+                f'INSERT INTO "{table}" ({", ".join(names)})'
+                f' VALUES ({", ".join("?" * len(names))})'
+            )
+        batch.append((sql, tuple(row.values())))
+        counts[table] += 1
+        if len(batch) >= batch_size:
+            flush()
+            yield counts
+    if batch:
+        flush()
+    yield counts
+
+
+# データベースの中身をNDJSONで書き出すカスタムコマンド
+@click.command('export')
+@click.argument('path', default='-')
+@click.option('--gzip', 'compress', is_flag=True, default=None,
+              help='Compress with gzip (default: when PATH ends with .gz).')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(list(TABLES)),
+              help='Tables to export (default: all).')
+@with_appcontext
+def export_command(path, compress, tables):
+    if compress is None:
+        compress = path.endswith('.gz')
+    tables = [table for table in TABLES if table in tables] if tables else list(TABLES)
+    stream = open_output(path, compress)
+    try:
+        counts = export_data(stream, tables)
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+    summary = ', '.join(f'{count} {table}' for table, count in counts.items())
+    click.echo(f'Exported {summary}.', err=True)
+
+
+# NDJSONをデータベースに読み込むカスタムコマンド
+@click.command('import')
+@click.argument('path', default='-')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Rows inserted per transaction.')
+@click.option('--resume', is_flag=True,
+              help='Skip rows up to the last id already in each table.')
+@with_appcontext
+def import_command(path, batch_size, resume):
+    stream = open_input(path)
+    try:
+        for counts in import_data(stream, batch_size, resume):
+            summary = ', '.join(f'{count} {table}' for table, count in counts.items())
+            click.echo(f'Imported {summary}.')
+    except (ValueError, KeyError, sqlite3.IntegrityError) as e:
+        raise click.ClickException(f'Import failed: {e}')
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+def init_app(app):
+    app.cli.add_command(export_command)
+    app.cli.add_command(import_command)
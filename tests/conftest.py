@@ -5,7 +5,7 @@ from flask import Flask, testing
 import pytest
 
 from flaskr import create_app
-from flaskr.db import get_db, init_db
+from flaskr.db import get_db, get_pool, init_db
 
 
 # テストデータを読み込み
@@ -13,15 +13,24 @@ with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf-8')
 
 
+# テストのモジュールで上書きすると、appの設定に加える
 @pytest.fixture
-def app():
+def config():
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, config):
     # 一時ファイルの作成
     db_fd, db_path = tempfile.mkstemp()
 
     # アプリケーションのインスタンスを作成（テストモード）
+    # コンパイルしたテンプレートはinstanceではなく一時ディレクトリに保存する
     app = create_app({
         'TESTING': True,
         'DATABASE': db_path,
+        'JINJA_BYTECODE_CACHE_DIR': str(tmp_path / 'jinja_cache'),
+        **config,
     })
 
     with app.app_context():
@@ -31,14 +40,25 @@ def app():
     # アプリケーションを返して待機（テストを開始する）
     yield app
 
-    # テストが終わって処理が戻ったら一時ファイルの後始末する
+    # テストが終わって処理が戻ったらプールの接続を閉じ、一時ファイルの後始末する
+    with app.app_context():
+        get_pool().close()
     os.close(db_fd)
     os.unlink(db_path)
 
 
+# 本文を最後まで読んでからレスポンスを返すテスト用のクライアント
+# ストリーミングのレスポンスは、本文を読まずに捨てると描画中のリクエストのコンテキストが残ってしまう
+# （WSGIサーバーは必ず最後まで読むか閉じる）
+class BufferedClient(testing.FlaskClient):
+    def open(self, *args, buffered=True, **kwargs):
+        return super().open(*args, buffered=buffered, **kwargs)
+
+
 # テストモードのアプリケーションからサーバーに接続せずにリクエストを作成
 @pytest.fixture
 def client(app: Flask):
+    app.test_client_class = BufferedClient
     return app.test_client()
 
 
@@ -0,0 +1,113 @@
+import gzip
+import os
+import shutil
+
+import pytest
+from flask import Flask, testing, url_for
+
+from flaskr.assets import VENDOR, _integrity, load_manifest
+
+
+def _build(app: Flask, runner: testing.FlaskCliRunner, tmp_path):
+    """staticの写しを一時ディレクトリに作ってビルドする"""
+    static = tmp_path / 'static'
+    shutil.copytree(app.static_folder, static)
+    app.static_folder = str(static)
+    result = runner.invoke(args=['build-assets'])
+    assert 'Built 2 files' in result.output
+    return static
+
+
+def test_build_assets(app: Flask, client: testing.FlaskClient,
+                      runner: testing.FlaskCliRunner, tmp_path):
+    """ビルドするとurl_forはハッシュつきの名前を返し、圧縮済みのファイルを1年間キャッシュさせる"""
+    static = _build(app, runner, tmp_path)
+    with app.test_request_context():
+        url = url_for('static', filename='style.css')
+    assert url.startswith('/static/build/style.') and url.endswith('.css')
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.content_encoding == 'gzip'
+    assert response.mimetype == 'text/css'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == (static / 'style.css').read_bytes()
+
+    # gzipを受け付けなければ元のファイルを返す
+    response = client.get(url)
+    assert response.content_encoding is None
+    assert response.data == (static / 'style.css').read_bytes()
+
+    # ページもハッシュつきの名前で参照する
+    assert url.encode() in client.get('/').data
+
+
+def test_build_image(app: Flask, client: testing.FlaskClient,
+                     runner: testing.FlaskCliRunner, tmp_path):
+    """圧縮済みの種類のファイルは圧縮せずに書き出し、ハッシュつきの名前で1年間キャッシュさせる"""
+    static = tmp_path / 'static'
+    shutil.copytree(app.static_folder, static)
+    (static / 'logo.png').write_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 100)
+    app.static_folder = str(static)
+    result = runner.invoke(args=['build-assets'])
+    assert 'Built 3 files' in result.output
+    with app.test_request_context():
+        url = url_for('static', filename='logo.png')
+    assert url.startswith('/static/build/logo.') and url.endswith('.png')
+    assert not list((static / 'build').glob('logo.*.png.gz'))
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.content_encoding is None
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+    assert response.data == (static / 'logo.png').read_bytes()
+
+
+def test_without_manifest(app: Flask, client: testing.FlaskClient):
+    """ビルドしていなければ元の名前のまま返す"""
+    with app.test_request_context():
+        assert url_for('static', filename='style.css') == '/static/style.css'
+    response = client.get('/static/style.css')
+    assert response.status_code == 200
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+
+
+def test_vendor_asset(app: Flask, client: testing.FlaskClient, tmp_path):
+    """staticに置いた外部のファイルを自前で配信し、ないときだけCDNのURLを使う"""
+    static = tmp_path / 'static'
+    path = static / 'vendor/purecss/pure-min.css'
+    path.parent.mkdir(parents=True)
+    path.write_text('')
+    app.static_folder = str(static)
+    app.extensions['flaskr_assets'] = load_manifest(app)
+    url, integrity = VENDOR['vendor/purecss/pure-min.css']
+    data = client.get('/').get_data(as_text=True)
+    assert url not in data
+    assert 'href="/static/vendor/purecss/pure-min.css"' in data
+    assert f'integrity="{integrity}"' in data
+    assert 'unpkg.com' not in data
+
+    # ファイルがあるかどうかは描画のたびには調べない
+    path.unlink()
+    app.extensions['flaskr_response_cache'].clear()
+    assert 'href="/static/vendor/purecss/pure-min.css"' in client.get('/').get_data(as_text=True)
+
+    app.extensions['flaskr_assets'] = load_manifest(app)
+    app.extensions['flaskr_response_cache'].clear()
+    data = client.get('/').get_data(as_text=True)
+    assert url in data
+    assert f'integrity="{integrity}"' in data
+
+
+def test_vendored_files(app: Flask):
+    """リポジトリに置いた外部のファイルはSRIのハッシュと一致する"""
+    for filename, (url, integrity) in VENDOR.items():
+        path = os.path.join(app.static_folder, filename)
+        if not os.path.exists(path):
+            pytest.skip(f'{filename} is not vendored; run flask build-assets --vendor.')
+        with open(path, 'rb') as f:
+            assert _integrity(f.read(), integrity.split('-', 1)[0]) == integrity
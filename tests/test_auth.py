@@ -1,7 +1,12 @@
 import pytest
 from flask import testing, Flask, session, g
 
+from werkzeug.exceptions import ServiceUnavailable
+
 from flaskr.db import get_db
+from flaskr.passwords import PasswordHasher
+from flaskr.ratelimit import RateLimiter
+from flaskr.routes.auth import forget_user
 
 
 def test_register(client: testing.FlaskClient, app: Flask):
@@ -40,9 +45,104 @@ def test_login(client: testing.FlaskClient, auth):
         assert g.user['username'] == 'test'
 
 
+def test_login_no_write(app: Flask, auth):
+    """ログインしてもcache_generationには書き込まない"""
+    with app.app_context():
+        before = get_db().execute('SELECT * FROM cache_generation').fetchall()
+    auth.login()
+    with app.app_context():
+        after = get_db().execute('SELECT * FROM cache_generation').fetchall()
+    assert [tuple(row) for row in after] == [tuple(row) for row in before]
+
+
 def test_logout(client: testing.FlaskClient, auth):
     auth.login()
 
     with client:
         auth.logout()
         assert 'user-id' not in session
+
+
+def test_user_cache(app: Flask, client: testing.FlaskClient, auth):
+    """ログインユーザーの情報はキャッシュされ、forget_user()で捨てられる"""
+    auth.login()
+    assert b'test [id:1]' in client.get('/').data
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        db.commit()
+
+    # キャッシュが残っている間は問い合わせない
+    assert b'test [id:1]' in client.get('/').data
+
+    with app.app_context():
+        forget_user(1)
+    assert b'renamed [id:1]' in client.get('/').data
+
+    # パスワードのハッシュはキャッシュしない
+    with client:
+        client.get('/')
+        assert g.user.keys() == ['id', 'username']
+
+
+def test_user_cache_ttl(app: Flask, client: testing.FlaskClient, auth):
+    """有効期限が切れたらユーザー情報を取得し直す"""
+    app.extensions['flaskr_user_cache'].ttl = 0
+    auth.login()
+    client.get('/')
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        db.commit()
+    assert b'renamed [id:1]' in client.get('/').data
+
+
+def test_password_hash_method(app: Flask, client: testing.FlaskClient):
+    """パスワードのハッシュは設定した方式で作られる"""
+    app.extensions['flaskr_password_hasher'].method = 'pbkdf2:sha256:1000'
+    client.post('/auth/register', data={'username': 'a', 'password': 'a'})
+
+    with app.app_context():
+        user = get_db().execute("SELECT * FROM user WHERE username = 'a'").fetchone()
+        assert user['password'].startswith('pbkdf2:sha256:1000$')
+
+
+def test_password_hasher_busy():
+    """待ちの上限を超えたら503になる"""
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, max_pending=1, timeout=0)
+    assert hasher.check(hasher.hash('a'), 'a')
+
+    hasher._pending.acquire()
+    with pytest.raises(ServiceUnavailable):
+        hasher.hash('a')
+
+
+def test_login_rate_limit(app: Flask, client: testing.FlaskClient, auth, monkeypatch):
+    """試行回数の制限を超えたらハッシュを計算せずに429を返す"""
+    app.extensions['flaskr_auth_limiter'] = RateLimiter(2, 60, 100)
+    assert auth.login(password='wrong').status_code == 200
+    assert auth.login(password='wrong').status_code == 200
+
+    def fail_check(*args):
+        raise AssertionError('hashed')
+
+    monkeypatch.setattr(app.extensions['flaskr_password_hasher'], 'check', fail_check)
+    assert auth.login().status_code == 429
+
+    # GETは制限しない
+    assert client.get('/auth/login').status_code == 200
+
+
+def test_rate_limiter():
+    """トークンはキーごとに時間で補充される"""
+    now = [0]
+    limiter = RateLimiter(2, 60, 100, clock=lambda: now[0])
+    assert limiter.allow('a') and limiter.allow('a')
+    assert not limiter.allow('a')
+    assert limiter.allow('b')
+
+    now[0] = 1
+    assert limiter.allow('a')
+    assert not limiter.allow('a')
@@ -1,8 +1,12 @@
+import re
+from urllib.parse import unquote_plus
+
 import pytest
 from flask import testing, Flask
 
 from conftest import AuthAction
 
+from flaskr.cache import NullCache, ResponseCache, invalidate_pages
 from flaskr.db import get_db
 
 
@@ -27,6 +31,75 @@ def test_index(client: testing.FlaskClient, auth: AuthAction):
     assert b'/1' in res.data
 
 
+# indexのページ送りのテスト
+# 1ページ目は新しい順にPOSTS_PER_PAGE件、古い投稿へのリンクだけがあるはず
+# 古い投稿・新しい投稿のリンクをたどると隣のページが表示されるはず
+def test_index_pagination(app: Flask, client: testing.FlaskClient):
+    app.config['POSTS_PER_PAGE'] = 2
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created) VALUES (?, ?, 1, ?)',
+            [(f'page title{i}', 'body', f'2018-01-0{i} 00:00:00') for i in range(2, 6)]
+        )
+        db.commit()
+
+    res = client.get('/')
+    html = res.get_data(as_text=True)
+    assert 'page title5' in html and 'page title4' in html
+    assert 'page title3' not in html
+    assert 'after=' not in html
+    assert 'before=2018-01-04+00%3A00%3A00_4' in html
+
+    html = client.get('/?before=2018-01-04 00:00:00_4').get_data(as_text=True)
+    assert 'page title3' in html and 'page title2' in html
+    assert 'page title4' not in html
+    assert 'after=2018-01-03+00%3A00%3A00_3' in html
+    assert 'before=2018-01-02+00%3A00%3A00_2' in html
+
+    html = client.get('/?before=2018-01-02 00:00:00_2').get_data(as_text=True)
+    assert 'test title' in html
+    assert 'before=' not in html
+
+    html = client.get('/?after=2018-01-03 00:00:00_3').get_data(as_text=True)
+    assert 'page title5' in html and 'page title4' in html
+    assert 'after=' not in html
+
+    # 'T' 区切りの日時も保存されている形にそろえて比べる
+    html = client.get('/?before=2018-01-04T00:00:00_4').get_data(as_text=True)
+    assert 'page title3' in html and 'page title2' in html
+    assert 'page title4' not in html
+
+    assert client.get('/?before=hoge').status_code == 400
+    assert client.get('/?before=2018-01-04 00:00:00_99999999999999999999').status_code == 400
+    assert client.get('/?before=2018-01-04 00:00:00_0').status_code == 400
+    assert client.get('/?after=2018-01-04 00:00:00+09:00_4').status_code == 400
+
+
+def test_index_pagination_fractional(app: Flask, client: testing.FlaskClient):
+    """小数点以下の秒がある日時でも、ページの境目で行を飛ばしたり繰り返したりしない"""
+    app.config['POSTS_PER_PAGE'] = 2
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created) VALUES (?, ?, 1, ?)',
+            [(f'frac title{i}', 'body', f'2030-01-01 00:00:00.{i}') for i in ('5', '25', '125', '0625')]
+            + [('frac titleX', 'body', '2030-01-01 00:00:00')]
+        )
+        db.commit()
+
+    seen = []
+    html = client.get('/').get_data(as_text=True)
+    while True:
+        seen.extend(re.findall(r'class="article-title">([^<]+)<', html))
+        cursor = re.search(r'before=([^"]+)"', html)
+        if cursor is None:
+            break
+        html = client.get('/?before=' + unquote_plus(cursor.group(1))).get_data(as_text=True)
+    assert seen[:5] == ['frac title5', 'frac title25', 'frac title125', 'frac title0625', 'frac titleX']
+    assert len(seen) == len(set(seen))
+
+
 # indexのテスト(2)
 # /create, /<id>/update, /<id>/delete へのアクセスはログイン要
 # ログインしていない場合は /auth/login へ飛ぶはず
@@ -60,6 +133,17 @@ def test_exists_required(client: testing.FlaskClient, auth: AuthAction, path):
     assert client.post(path).status_code == 404
 
 
+# 存在しない投稿にはコメント・投票できない（外部キーの制約）
+def test_exists_required_comment_vote(app: Flask, client: testing.FlaskClient, auth: AuthAction):
+    auth.login()
+    assert client.post('/2/comment/create', data={'body': 'orphan'}).status_code == 404
+    assert client.post('/2/vote', data={'intention': '1'}).status_code == 404
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT count(*) FROM comment WHERE post_id = 2').fetchone()[0] == 0
+        assert db.execute('SELECT count(*) FROM vote WHERE post_id = 2').fetchone()[0] == 0
+
+
 # createのテスト
 # ログインしていればGETは200を返すはず
 # ログインしていればPOSTで新しい投稿ができるはず
@@ -102,6 +186,7 @@ def test_create_update_validate(client, auth: AuthAction, path):
 # 削除したらそのidの投稿はデータベースからなくなっているはず
 def test_delete(app: Flask, client: testing.FlaskClient, auth: AuthAction):
     auth.login()
+    client.post('/1/vote', data={'intention': '1'})
     res = client.post('/1/delete')
     assert res.headers['Location'] == '/'
 
@@ -109,6 +194,9 @@ def test_delete(app: Flask, client: testing.FlaskClient, auth: AuthAction):
         db = get_db()
         post = db.execute('SELECT * FROM post WHERE id = 1').fetchone()
         assert post is None
+        # コメント・投票も一緒に消える
+        assert db.execute('SELECT count(*) FROM comment WHERE post_id = 1').fetchone()[0] == 0
+        assert db.execute('SELECT count(*) FROM vote WHERE post_id = 1').fetchone()[0] == 0
 
 
 # articleのテスト
@@ -221,11 +309,28 @@ def test_vote_error(app: Flask, client: testing.FlaskClient, auth: AuthAction):
     res = client.post('/1/vote', data={'intention': '2'})
     assert b'illegal value.' in res.data
 
-    # 重複投票
+    # 同じ意見への重複投票
+    client.post('/1/vote', data={'intention': '1'})
+    res = client.post('/1/vote', data={'intention': '1'})
+    assert b'you are already vote.' in res.data
     with app.app_context():
-        client.post('/1/vote', data={'intention': '1'})
-        res = client.post('/1/vote', data={'intention': '0'})
-        assert b'you are already vote.' in res.data
+        assert get_db().execute('SELECT count(*) FROM vote').fetchone()[0] == 1
+
+
+def test_vote_switch(app: Flask, client: testing.FlaskClient, auth: AuthAction):
+    """投票済なら取り消さずに賛成・反対を切り替えられる"""
+    auth.login()
+    client.post('/1/vote', data={'intention': '1'})
+    res = client.get('/1')
+    assert '賛成(1) 反対(0)' in res.get_data(as_text=True)
+    assert '反対に変更する' in res.get_data(as_text=True)
+
+    res = client.post('/1/vote', data={'intention': '0'})
+    assert res.headers['Location'] == '/1'
+    res = client.get('/1')
+    assert '賛成(0) 反対(1)' in res.get_data(as_text=True)
+    assert '反対に投票済' in res.get_data(as_text=True)
+    assert '賛成に変更する' in res.get_data(as_text=True)
 
 
 def test_vote_view(client: testing.FlaskClient, auth: AuthAction):
@@ -292,9 +397,17 @@ def test_author_search(app: Flask, client: testing.FlaskClient):
     res = client.get('/search?author=test')
     assert '1件' in res.get_data(as_text=True)
 
-    # 投稿者名（一部一致）
+    # 投稿者名（前方一致）
     res = client.get('/search?author=t')
-    assert '2件' in res.get_data(as_text=True)
+    assert '1件' in res.get_data(as_text=True)
+    res = client.get('/search?author=oth')
+    html = res.get_data(as_text=True)
+    assert '1件' in html and 'test title2' in html
+    res = client.get('/search?author=est')
+    assert '0件' in res.get_data(as_text=True)
+    # GLOBの記号は文字として扱う
+    res = client.get('/search?author=*')
+    assert '0件' in res.get_data(as_text=True)
 
     # 投稿者名が存在しなければ0件
     res = client.get('/search?author=hoge')
@@ -327,4 +440,247 @@ def test_markdown_view(app: Flask, client: testing.FlaskClient):
 
     # 記事一覧ではmarkdownの部分が取り除かれている
     res = client.get('/')
-    assert b'# hoge' not in res.data
\ No newline at end of file
+    assert b'# hoge' not in res.data
+
+
+def test_fulltext_search(app: Flask, client: testing.FlaskClient):
+    '''全文検索のテスト'''
+    # preprocess
+    app.config['POSTS_PER_PAGE'] = 2
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 2)',
+            [('apple pie', 'how to bake <apple> pie'),
+             ('banana', 'apple and banana'),
+             ('cherry', 'apple apple apple')]
+        )
+        db.commit()
+
+    # 本文・タイトルに一致した記事がハイライト付きで表示される
+    res = client.get('/search?q=banana')
+    html = res.get_data(as_text=True)
+    assert '1件' in html
+    assert '<mark>banana</mark>' in html
+
+    # 本文はエスケープされる
+    html = client.get('/search?q=bake').get_data(as_text=True)
+    assert '<mark>bake</mark> &lt;apple&gt;' in html
+
+    # 作者名でも一致する
+    assert '3件' in client.get('/search?q=other').get_data(as_text=True)
+
+    # ページ送り
+    html = client.get('/search?q=apple').get_data(as_text=True)
+    assert '3件' in html
+    assert 'page=2' in html
+    html = client.get('/search?q=apple&page=2').get_data(as_text=True)
+    assert html.count('class="article-title"') == 1
+    assert 'page=1' in html and 'page=3' not in html
+
+    # 順位を付けるのは一致した中の新しい SEARCH_RANK_LIMIT 件だけで、ページ送りもそこまで
+    app.config['SEARCH_RANK_LIMIT'] = 2
+    app.extensions['flaskr_response_cache'].clear()
+    html = client.get('/search?q=apple').get_data(as_text=True)
+    assert '3件' in html
+    assert '新しい2件を関連の高い順に表示しています' in html
+    assert 'page=2' not in html
+    assert html.index('cherry') < html.index('banana')
+    assert 'apple pie' not in html
+    app.config['SEARCH_RANK_LIMIT'] = 1000
+    app.extensions['flaskr_response_cache'].clear()
+
+    # FTS5の構文になる記号もそのまま検索語として扱う
+    assert '0件' in client.get('/search?q=apple"+OR').get_data(as_text=True)
+    # 制御文字は取り除き、範囲外のページ番号は上限に丸める
+    assert '0件' in client.get('/search?q=%00').get_data(as_text=True)
+    assert '3件' in client.get('/search?q=apple%00').get_data(as_text=True)
+    res = client.get('/search?q=apple&page=99999999999999999999')
+    assert res.status_code == 200
+    assert client.get('/search?author=test&page=99999999999999999999').status_code == 200
+
+    # 更新・削除が索引に反映される
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET body = 'durian' WHERE title = 'banana'")
+        db.execute("DELETE FROM post WHERE title = 'cherry'")
+        db.commit()
+        # 直接書き換えたのでページのキャッシュを無効にする
+        invalidate_pages('list')
+    assert '0件' in client.get('/search?q=banana+apple').get_data(as_text=True)
+    assert '1件' in client.get('/search?q=durian').get_data(as_text=True)
+    assert '1件' in client.get('/search?q=apple').get_data(as_text=True)
+
+    # 作者名の変更も索引に反映される
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'someone' WHERE id = 2")
+        db.commit()
+        invalidate_pages('list')
+    assert '0件' in client.get('/search?q=other').get_data(as_text=True)
+    assert '2件' in client.get('/search?q=someone').get_data(as_text=True)
+
+
+def test_page_cache(app: Flask, client: testing.FlaskClient, auth: AuthAction):
+    '''ログインしていないユーザー向けのページのキャッシュのテスト'''
+    assert b'test title' in client.get('/').data
+    assert b'test title' in client.get('/1').data
+
+    # 直接書き換えてもキャッシュされたページが返る
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'direct title' WHERE id = 1")
+        db.commit()
+    assert b'test title' in client.get('/').data
+    assert b'test title' in client.get('/1').data
+
+    # クエリ文字列が違えば別のページ
+    assert b'direct title' in client.get('/?before=2019-01-01 00:00:00_9').data
+
+    # ログインしていればキャッシュを使わない
+    auth.login()
+    assert b'direct title' in client.get('/').data
+
+    # 書き込むと関係するページのキャッシュが無効になる
+    client.post('/1/comment/create', data={'body': 'invalidate'})
+    auth.logout()
+    assert b'direct title' in client.get('/').data
+    res = client.get('/1')
+    assert b'direct title' in res.data
+    assert b'invalidate' in res.data
+
+
+def test_page_cache_flash(client: testing.FlaskClient):
+    '''flashのメッセージを表示したページはキャッシュしない'''
+    res = client.get('/search?author=')
+    assert '検索条件を指定してください' in res.get_data(as_text=True)
+    res = client.get('/search?author=')
+    assert '検索条件を指定してください' in res.get_data(as_text=True)
+
+
+def test_streamed_pages(app: Flask, client: testing.FlaskClient):
+    '''一覧と検索は描画しながら送り出し、最後まで送ったページはキャッシュする'''
+    res = client.get('/search?q=test', buffered=False)
+    assert res.is_streamed
+    # 本文を読む前に、描画の途中までの断片を受け取れる
+    first = next(iter(res.response))
+    assert b'<!DOCTYPE html>' in first
+    assert b'test title' in first + b''.join(res.response)
+    res.close()
+
+    res = client.get('/', buffered=False)
+    assert res.is_streamed
+    assert res.headers['ETag']
+    assert b'test title' in res.get_data()
+
+    # 送り終えたページはキャッシュから返る
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'direct title' WHERE id = 1")
+        db.commit()
+    assert b'test title' in client.get('/').data
+
+
+def test_streamed_flash(client: testing.FlaskClient):
+    '''描画しながら表示したflashのメッセージは次のページには残らない'''
+    assert '検索条件を指定してください' in client.get('/search?author=').get_data(as_text=True)
+    assert '検索条件を指定してください' not in client.get('/').get_data(as_text=True)
+
+
+def test_page_cache_backend(app: Flask, client: testing.FlaskClient):
+    '''保存先を無効にするとキャッシュしない'''
+    app.extensions['flaskr_response_cache'] = ResponseCache(NullCache())
+    client.get('/')
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'direct title' WHERE id = 1")
+        db.commit()
+    assert b'direct title' in client.get('/').data
+
+
+@pytest.mark.parametrize('path', ('/', '/1'))
+def test_conditional_get(client: testing.FlaskClient, auth: AuthAction, path):
+    '''ETagによる条件付きGETのテスト'''
+    res = client.get(path)
+    etag, _ = res.get_etag()
+    assert etag is not None
+    assert res.last_modified is not None
+    assert res.cache_control.no_cache
+
+    # 変わっていなければ304（キャッシュされたページでも同じ）
+    res = client.get(path, headers={'If-None-Match': f'"{etag}"'})
+    assert res.status_code == 304
+    assert res.data == b''
+
+    # ログインしているユーザーには別のETag
+    auth.login()
+    res = client.get(path, headers={'If-None-Match': f'"{etag}"'})
+    assert res.status_code == 200
+    user_etag, _ = res.get_etag()
+    assert client.get(path, headers={'If-None-Match': f'"{user_etag}"'}).status_code == 304
+
+    # コメント・投票・更新のたびに変わる
+    for url, data in (('/1/comment/create', {'body': 'etag'}),
+                      ('/1/vote', {'intention': '1'}),
+                      ('/1/update', {'title': 'etag', 'body': 'etag'})):
+        client.post(url, data=data)
+        res = client.get(path, headers={'If-None-Match': f'"{user_etag}"'})
+        assert res.status_code == 200
+        user_etag, _ = res.get_etag()
+
+    auth.logout()
+    assert client.get(path, headers={'If-None-Match': f'"{etag}"'}).status_code == 200
+
+
+def test_article_queries(app: Flask, client: testing.FlaskClient, auth: AuthAction):
+    '''記事の詳細ページは記事とコメントの2回の問い合わせで表示する'''
+    statements = []
+
+    @app.before_request
+    def trace_queries():
+        statements.clear()
+        get_db().set_trace_callback(statements.append)
+
+    auth.login()
+    client.post('/1/vote', data={'intention': '0'})
+    res = client.get('/1')
+    assert '賛成(0) 反対(1)' in res.get_data(as_text=True)
+    assert '反対に投票済' in res.get_data(as_text=True)
+    assert len(statements) == 2
+
+    # 変わっていなければ記事の1回だけ
+    etag, _ = res.get_etag()
+    client.get('/1', headers={'If-None-Match': f'"{etag}"'})
+    assert len(statements) == 1
+
+
+def test_comments_pagination(app: Flask, client: testing.FlaskClient):
+    '''コメントのページ送りとJSONのテスト'''
+    app.config['COMMENTS_PER_PAGE'] = 2
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO comment (post_id, commenter_id, body, created) VALUES (1, 2, ?, ?)',
+            [(f'comment{i}', f'2100-01-0{i} 00:00:00') for i in range(2, 5)]
+        )
+        db.commit()
+
+    # 記事の詳細ページには新しい順に2件と続きのリンク
+    html = client.get('/1').get_data(as_text=True)
+    assert 'コメント(4)' in html
+    assert 'comment4' in html and 'comment3' in html
+    assert 'comment2' not in html
+    assert '/1/comments?after=2100-01-03+00%3A00%3A00_3' in html
+
+    # 続きはJSONで返す
+    data = client.get('/1/comments?after=2100-01-03 00:00:00_3').get_json()
+    assert [c['body'] for c in data['comments']] == ['comment2', 'test comment']
+    assert data['comments'][0] == {
+        'id': 2, 'post_id': 1, 'commenter_id': 2, 'username': 'other',
+        'created': '2100-01-02 00:00:00', 'body': 'comment2',
+    }
+    assert data['next'] is None
+
+    data = client.get('/1/comments').get_json()
+    assert [c['body'] for c in data['comments']] == ['comment4', 'comment3']
+    assert data['next'] == '2100-01-03 00:00:00_3'
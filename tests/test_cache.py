@@ -0,0 +1,113 @@
+from flask import Flask, testing
+import pytest
+
+from conftest import AuthAction, BufferedClient
+from flaskr import create_app
+from flaskr.cache import LRUCache, commit_and_invalidate, invalidate_pages
+from flaskr.db import get_db, get_pool
+from flaskr.routes.auth import forget_user
+
+
+def test_lru_cache():
+    """上限を超えたら最も使われていないものから捨てる"""
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache.delete('a')
+    assert cache.get('a', 'default') == 'default'
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_cache_ttl():
+    """有効期限が切れたものは返さない"""
+    now = [0]
+    cache = LRUCache(2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    now[0] = 9
+    assert cache.get('a') == 1
+    now[0] = 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+@pytest.fixture
+def other_app(app: Flask):
+    """同じデータベースを使う別のプロセスの代わりのアプリケーション"""
+    other = create_app({'TESTING': True, 'DATABASE': app.config['DATABASE'],
+                       'JINJA_BYTECODE_CACHE_DIR': None})
+    other.test_client_class = BufferedClient
+    yield other
+    with other.app_context():
+        get_pool().close()
+
+
+def test_cross_process_invalidation(app: Flask, client: testing.FlaskClient,
+                                    auth: AuthAction, other_app: Flask):
+    """別のプロセスでの書き込みで、関係する名前空間のキャッシュだけが無効になる"""
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (title, body, author_id) VALUES ('second', 'body', 1)")
+        db.commit()
+    other = other_app.test_client()
+    assert b'test comment' in other.get('/1').data
+    assert b'second' in other.get('/2').data
+    assert b'second' in other.get('/').data
+
+    auth.login()
+    client.post('/2/update', data={'title': 'updated', 'body': 'body'})
+
+    # 記事1のページはキャッシュから返し、一覧と記事2のページは作り直す
+    hits = other_app.extensions['flaskr_response_cache'].backend.hits
+    assert b'test comment' in other.get('/1').data
+    assert other_app.extensions['flaskr_response_cache'].backend.hits == hits + 1
+    assert b'updated' in other.get('/2').data
+    assert b'updated' in other.get('/').data
+
+
+def test_cross_process_user(app: Flask, other_app: Flask):
+    """別のプロセスでforget_user()すると、ログインユーザーのキャッシュからも捨てられる"""
+    other = other_app.test_client()
+    AuthAction(other).login()
+    assert b'test [id:1]' in other.get('/').data
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET username = 'renamed' WHERE id = 1")
+        forget_user(1)
+        db.commit()
+    assert b'renamed [id:1]' in other.get('/').data
+
+
+def test_generation_check_disabled(app: Flask, client: testing.FlaskClient, other_app: Flask):
+    """CACHE_GENERATION_CHECKが偽なら世代を読まない"""
+    other_app.config['CACHE_GENERATION_CHECK'] = False
+    other = other_app.test_client()
+    assert b'test title' in other.get('/1').data
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'direct title' WHERE id = 1")
+        invalidate_pages('post:1')
+        db.commit()
+    assert b'test title' in other.get('/1').data
+    assert b'direct title' in client.get('/1').data
+
+
+def test_invalidate_after_commit(app: Flask, client: testing.FlaskClient):
+    """コミットの前に描画されたページは、コミットした後のキャッシュからは返さない"""
+    app.config['CACHE_GENERATION_CHECK'] = False
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'direct title' WHERE id = 1")
+        invalidate_pages('post:1')
+        # コミットまでの間に来たリクエスト（別の接続）は古い内容を描画してキャッシュする
+        with app.app_context():
+            assert b'test title' in client.get('/1').data
+        commit_and_invalidate()
+    assert b'direct title' in client.get('/1').data
@@ -0,0 +1,110 @@
+import gzip
+import zlib
+
+from flask import Flask, stream_with_context, testing
+from werkzeug.test import Client
+
+from flaskr.compress import CompressMiddleware
+
+
+def test_compress_page(client: testing.FlaskClient):
+    """gzipを受け付けるクライアントには圧縮したページを返す"""
+    plain = client.get('/')
+    assert plain.content_encoding is None
+    assert 'Accept-Encoding' in plain.headers['Vary']
+
+    res = client.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert res.content_encoding == 'gzip'
+    assert 'Accept-Encoding' in res.headers['Vary']
+    assert gzip.decompress(res.data) == plain.data
+    assert len(res.data) < len(plain.data)
+
+
+def test_min_size(app: Flask, client: testing.FlaskClient):
+    """COMPRESS_MIN_SIZE 未満の本文は圧縮しない"""
+    res = client.get('/hello', headers={'Accept-Encoding': 'gzip'})
+    assert res.content_encoding is None
+    assert res.data == b'Hello, Flask!'
+
+    app.config['COMPRESS_MIN_SIZE'] = 0
+    res = client.get('/hello', headers={'Accept-Encoding': 'gzip'})
+    assert res.content_encoding == 'gzip'
+    assert gzip.decompress(res.data) == b'Hello, Flask!'
+
+
+def test_compressed_types(app: Flask, client: testing.FlaskClient):
+    """圧縮済みの種類の本文・Content-Encodingのある本文はそのまま返す"""
+    app.add_url_rule('/image', 'image',
+                     lambda: app.response_class(b'x' * 1000, mimetype='image/png'))
+    res = client.get('/image', headers={'Accept-Encoding': 'gzip'})
+    assert res.content_encoding is None
+    assert 'Vary' not in res.headers
+    assert res.data == b'x' * 1000
+
+    # SVGはテキストなので圧縮する
+    app.add_url_rule('/svg', 'svg',
+                     lambda: app.response_class(b'<svg></svg>' * 100, mimetype='image/svg+xml'))
+    res = client.get('/svg', headers={'Accept-Encoding': 'gzip'})
+    assert res.content_encoding == 'gzip'
+    assert gzip.decompress(res.data) == b'<svg></svg>' * 100
+
+
+def test_write(app: Flask):
+    """write()を使うWSGIアプリケーションのレスポンスは圧縮せずにそのまま送る"""
+    def legacy_app(environ, start_response):
+        write = start_response('200 OK', [('Content-Type', 'text/plain')])
+        write(b'written ' * 100)
+        return [b'returned']
+
+    client = Client(CompressMiddleware(legacy_app, app.config))
+    res = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert res.status_code == 200
+    assert res.content_encoding is None
+    assert res.data == b'written ' * 100 + b'returned'
+
+
+def test_streamed(app: Flask, client: testing.FlaskClient):
+    """ストリーミングの本文はしきい値を超えたらチャンクごとに送り出し、届いた分だけで展開できる"""
+    app.config['COMPRESS_MIN_SIZE'] = 10
+
+    def generate():
+        yield 'short'
+        for i in range(3):
+            yield f'chunk {i} ' * 10
+
+    app.add_url_rule('/stream', 'stream',
+                     lambda: app.response_class(stream_with_context(generate())))
+    res = client.get('/stream', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+    assert res.content_encoding == 'gzip'
+    assert 'Content-Length' not in res.headers
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    received = [decompressor.decompress(chunk) for chunk in res.response]
+    res.close()
+    assert received[0] == b'short' + b'chunk 0 ' * 10
+    assert received[1] == b'chunk 1 ' * 10
+    assert b''.join(received) == b'short' + b''.join(f'chunk {i} '.encode() * 10 for i in range(3))
+
+    # しきい値に届かずに終われば圧縮しない
+    app.config['COMPRESS_MIN_SIZE'] = 1000
+    res = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert res.content_encoding is None
+    assert res.headers['Content-Length'] == str(len(res.data))
+
+
+def test_etag(client: testing.FlaskClient):
+    """圧縮した本文のETagには接尾辞を付け、それでの条件付きGETにも304を返す"""
+    etag = client.get('/1').headers['ETag']
+    res = client.get('/1', headers={'Accept-Encoding': 'gzip'})
+    assert res.headers['ETag'] == etag[:-1] + '-gzip"'
+
+    res = client.get('/1', headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.headers['ETag']})
+    assert res.status_code == 304
+    assert res.headers['ETag'] == etag[:-1] + '-gzip"'
+    assert 'Accept-Encoding' in res.headers['Vary']
+
+
+def test_disabled():
+    from flaskr import create_app
+    app = create_app({'TESTING': True, 'COMPRESS_ENABLED': False, 'JINJA_BYTECODE_CACHE_DIR': None})
+    assert not hasattr(app.wsgi_app, 'config')
@@ -1,9 +1,11 @@
+import os
 import sqlite3
 
 from flask import Flask, testing
 import pytest
 
-from flaskr.db import get_db
+from conftest import _data_sql
+from flaskr.db import get_db, get_migrations, get_pool
 
 
 def test_get_close_db(app: Flask):
@@ -12,6 +14,21 @@ def test_get_close_db(app: Flask):
     with app.app_context():
         db = get_db()
         assert db is get_db()
+        # 途中のトランザクションはコミットしないまま終わる
+        db.execute("UPDATE post SET title = 'rollback'")
+
+    # コンテキストが終わると接続はプールに戻り、次のコンテキストで使い回される
+    # プールに戻すときにトランザクションはロールバックされている
+    with app.app_context():
+        assert get_db() is db
+        assert not db.in_transaction
+        assert db.execute('SELECT title FROM post').fetchone()[0] == 'test title'
+
+    # プールの大きさが0のときはコンテキストが終わると接続を閉じる
+    app.config['DATABASE_POOL_SIZE'] = 0
+    with app.app_context():
+        get_pool().close()
+        db = get_db()
 
     # pytest.raises(exception)  異常系のテスト
     # sqlite3にエラーが生じた時、出力されるエラーの文言に'closed'が含まれている
@@ -20,6 +37,19 @@ def test_get_close_db(app: Flask):
     assert 'closed' in str(e.value)
 
 
+def test_connection_pragmas(app: Flask):
+    """接続ごとのPRAGMAは設定に従う"""
+    app.config['DATABASE_CACHE_SIZE'] = -2000
+    with app.app_context():
+        get_pool().close()
+        db = get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert db.execute('PRAGMA cache_size').fetchone()[0] == -2000
+        assert db.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+        assert db.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+
+
 def test_init_db_command(runner: testing.FlaskCliRunner, monkeypatch: pytest.MonkeyPatch):
     """init-dbコマンドのテスト"""
     # 差し替え用のクラスの作成
@@ -35,3 +65,126 @@ def test_init_db_command(runner: testing.FlaskCliRunner, monkeypatch: pytest.Mon
     result = runner.invoke(args=['init-db'])
     assert 'Initialized' in result.output
     assert Recorder.called
+
+
+def test_counters(app: Flask):
+    """コメント・投票のトリガーで投稿のカウンタが更新される"""
+    with app.app_context():
+        db = get_db()
+        post = db.execute('SELECT * FROM post WHERE id = 1').fetchone()
+        assert (post['comment_count'], post['agree'], post['disagree']) == (1, 0, 0)
+
+        db.execute('INSERT INTO vote (post_id, user_id, intention) VALUES (1, 1, 1)')
+        db.execute('INSERT INTO vote (post_id, user_id, intention) VALUES (1, 2, 0)')
+        db.execute('UPDATE vote SET intention = 1 WHERE user_id = 2')
+        db.execute('DELETE FROM comment WHERE id = 1')
+        post = db.execute('SELECT * FROM post WHERE id = 1').fetchone()
+        assert (post['comment_count'], post['agree'], post['disagree']) == (0, 2, 0)
+
+
+def test_rebuild_counters_command(app: Flask, runner: testing.FlaskCliRunner):
+    """rebuild-countersコマンドのテスト"""
+    with app.app_context():
+        db = get_db()
+        db.execute('UPDATE post SET comment_count = 5, agree = 3, disagree = 2')
+        db.commit()
+
+    result = runner.invoke(args=['rebuild-counters'])
+    assert 'Rebuilt counters of 1 posts.' in result.output
+
+    with app.app_context():
+        post = get_db().execute('SELECT * FROM post WHERE id = 1').fetchone()
+        assert (post['comment_count'], post['agree'], post['disagree']) == (1, 0, 0)
+
+
+def test_init_db_version(app: Flask):
+    """init_db()で作ったデータベースは最新バージョンになっている"""
+    with app.app_context():
+        version = get_db().execute('PRAGMA user_version').fetchone()[0]
+        assert version == get_migrations()[-1][0]
+
+
+def test_db_upgrade_command(app: Flask, runner: testing.FlaskCliRunner):
+    """db-upgradeコマンドで古いスキーマのデータを残したまま最新にできる"""
+    # 最初のバージョンのスキーマとテストデータを作る
+    with app.app_context():
+        db = get_db()
+        db.execute('DROP TABLE post_fts')
+        db.execute('DROP TABLE cache_generation')
+        # 外部キーを有効にしていなかった頃のデータベースを作る
+        db.execute('PRAGMA foreign_keys = OFF')
+        with open(os.path.join(os.path.dirname(__file__), 'schema_v0.sql'), 'rb') as f:
+            db.executescript(f.read().decode('utf-8'))
+        db.executescript(_data_sql)
+        # 同じユーザーの重複した投票は後のものが残る
+        db.execute('INSERT INTO vote (post_id, user_id, intention) VALUES (1, 2, 1)')
+        db.execute('INSERT INTO vote (post_id, user_id, intention) VALUES (1, 2, 0)')
+        # 削除済みの投稿へのコメント・投票は移さない
+        db.execute("INSERT INTO comment (post_id, commenter_id, body) VALUES (9, 1, 'orphan')")
+        db.execute('INSERT INTO vote (post_id, user_id, intention) VALUES (9, 1, 1)')
+        db.execute('PRAGMA user_version = 0')
+        db.commit()
+        db.execute('PRAGMA foreign_keys = ON')
+
+    result = runner.invoke(args=['db-upgrade'])
+    assert 'Applied 0001_post_counters.sql.' in result.output
+    assert 'up to date' in result.output
+
+    with app.app_context():
+        db = get_db()
+        post = db.execute('SELECT * FROM all_posts WHERE id = 1').fetchone()
+        assert post['title'] == 'test title'
+        assert (post['comment_count'], post['agree'], post['disagree']) == (1, 0, 1)
+
+        indexes = {row['name'] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {'post_created_idx', 'comment_post_idx'} <= indexes
+        assert db.execute('SELECT count(*) FROM vote').fetchone()[0] == 1
+        assert db.execute('SELECT count(*) FROM comment').fetchone()[0] == 1
+        with pytest.raises(sqlite3.IntegrityError):
+            db.execute('INSERT INTO vote (post_id, user_id, intention) VALUES (1, 2, 1)')
+        db.rollback()
+        assert db.execute(
+            "SELECT rowid FROM post_fts WHERE post_fts MATCH 'test'").fetchone()[0] == 1
+        assert db.execute('PRAGMA user_version').fetchone()[0] == get_migrations()[-1][0]
+
+    # 2回目は何も適用しない
+    result = runner.invoke(args=['db-upgrade'])
+    assert 'Applied' not in result.output
+
+
+def test_db_maintain_command(app: Flask, runner: testing.FlaskCliRunner):
+    """db-maintainコマンドで参照先のない行を消し、空きページを返してWALを空にする"""
+    with app.app_context():
+        db = get_db()
+        assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        # 外部キーを有効にする前に残ったコメント・投票
+        db.execute('PRAGMA foreign_keys = OFF')
+        db.executemany('INSERT INTO comment (post_id, commenter_id, body) VALUES (?, 1, ?)',
+                       [(999, f'orphan {i}') for i in range(5)])
+        db.executemany('INSERT INTO vote (post_id, user_id, intention) VALUES (?, ?, 1)',
+                       [(999, 1), (999, 2), (1, 999)])
+        db.commit()
+        db.execute('PRAGMA foreign_keys = ON')
+        # 空きページを作る
+        db.executemany("INSERT INTO post (title, body, author_id) VALUES ('big', ?, 1)",
+                       [('x' * 4000,) for _ in range(50)])
+        db.commit()
+        db.execute("DELETE FROM post WHERE title = 'big'")
+        db.commit()
+        assert db.execute('PRAGMA freelist_count').fetchone()[0] > 0
+
+    result = runner.invoke(args=['db-maintain', '--batch-size', '2', '--vacuum-pages', '10'])
+    assert result.exit_code == 0, result.output
+    assert 'Deleted orphaned rows: 5 comment, 3 vote.' in result.output
+    assert 'Checkpointed and truncated the WAL.' in result.output
+    assert 'bytes reclaimed' in result.output
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT count(*) FROM comment').fetchone()[0] == 1
+        assert db.execute('SELECT count(*) FROM vote').fetchone()[0] == 0
+        assert db.execute('PRAGMA freelist_count').fetchone()[0] == 0
+        assert db.execute("SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+                          ).fetchone()[0] == 1
+        assert not os.path.getsize(app.config['DATABASE'] + '-wal')
@@ -0,0 +1,125 @@
+import json
+import logging
+import sqlite3
+
+from flask import Flask, testing
+import pytest
+
+from flaskr.db import get_db, get_pool
+from flaskr.instrument import InstrumentedConnection, summarize
+
+
+def test_disabled(app: Flask, client: testing.FlaskClient):
+    """無効なときは素の接続を使い、ヘッダーも付けない"""
+    with app.app_context():
+        assert type(get_db()) is sqlite3.Connection
+    assert 'Server-Timing' not in client.get('/1').headers
+
+
+def test_server_timing(app: Flask, client: testing.FlaskClient,
+                       caplog: pytest.LogCaptureFixture):
+    """有効なときはリクエストごとのSQLの件数と時間をヘッダーとログに出す"""
+    app.config['SQL_INSTRUMENTATION'] = True
+    app.config['RESPONSE_CACHE_BACKEND'] = 'null'
+    with app.app_context():
+        get_pool().close()
+
+    with caplog.at_level(logging.INFO, logger='flaskr.sql'):
+        response = client.get('/1')
+    timing = response.headers['Server-Timing']
+    # 記事のページはキャッシュの世代の確認の1文、記事（と投票）の1文とコメントの1文
+    assert 'db;dur=' in timing
+    assert 'desc="3 queries"' in timing
+    assert 'sql-1;dur=' in timing and 'sql-4' not in timing
+
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record['endpoint'] == 'blog.article'
+    assert record['status'] == 200
+    assert record['queries'] == 3
+    assert record['statements'][0]['sql'].startswith('SELECT')
+
+    # 接続をプールに戻すと記録は消え、次のリクエストは0から数える
+    response = client.get('/hello')
+    assert 'desc="0 queries"' in response.headers['Server-Timing']
+
+
+def test_max_statements(app: Flask):
+    """文ごとの記録は上限まで、件数と時間はすべて数える"""
+    app.config.update(SQL_INSTRUMENTATION=True, SQL_INSTRUMENTATION_MAX_STATEMENTS=2)
+    with app.app_context():
+        get_pool().close()
+        db = get_db()
+        assert isinstance(db, InstrumentedConnection)
+        for _ in range(5):
+            db.execute('SELECT 1')
+        assert db.query_count == 5
+        assert len(db.statements) == 2
+        assert db.query_time > 0
+
+
+def test_summarize():
+    assert summarize('SELECT *\n  FROM post') == 'SELECT * FROM post'
+    assert summarize('SELECT ' + 'x' * 100, 20) == 'SELECT xxxxxxxxxx...'
+
+
+def test_slow_query_log(app: Flask, client: testing.FlaskClient, runner: testing.FlaskCliRunner,
+                        tmp_path):
+    """しきい値以上のSQLをパラメータ・エンドポイント・実行計画とともに記録し、コマンドでまとめる"""
+    log = tmp_path / 'slow.log'
+    app.config.update(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_LOG=str(log))
+    with app.app_context():
+        get_pool().close()
+
+    client.get('/search?author=test')
+    entries = [json.loads(line) for line in log.read_text().splitlines()]
+    search = [entry for entry in entries if entry['endpoint'] == 'blog.search']
+    assert search
+    assert any(entry['plan'] for entry in search)
+    # パラメータの値（ユーザー名）は型と長さだけになっている
+    assert ['<str:5>'] in [entry['params'] for entry in search]
+
+    result = runner.invoke(args=['slow-queries'])
+    assert 'slow statements in' in result.output
+    assert '1 x  total' in result.output
+    # 作者の検索は作成日時の並べ替えに一時B-treeを使っている
+    assert 'temp b-tree]' in result.output
+    assert 'endpoints: blog.search' in result.output
+
+
+def test_slow_query_params(app: Flask, tmp_path):
+    """SLOW_QUERY_REDACTが偽ならパラメータをそのまま残し、しきい値未満は記録しない"""
+    log = tmp_path / 'slow.log'
+    app.config.update(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_LOG=str(log), SLOW_QUERY_REDACT=False)
+    with app.app_context():
+        get_pool().close()
+        db = get_db()
+        db.execute('SELECT * FROM post WHERE title = ?', ('test title',))
+        db.slow_query_threshold = 60
+        db.execute('SELECT 1')
+
+    entries = [json.loads(line) for line in log.read_text().splitlines()]
+    assert len(entries) == 1
+    assert entries[0]['params'] == ['test title']
+    assert entries[0]['endpoint'] is None
+    assert any('SCAN post' in line for line in entries[0]['plan'])
+
+
+def test_slow_queries_command_without_log(app: Flask, runner: testing.FlaskCliRunner, tmp_path):
+    app.config['SLOW_QUERY_LOG'] = str(tmp_path / 'missing.log')
+    result = runner.invoke(args=['slow-queries'])
+    assert result.exit_code != 0
+    assert 'No slow query log' in result.output
+
+
+def test_cached_page_timing(app: Flask, client: testing.FlaskClient):
+    """キャッシュしたページを返すときは、そのリクエストのServer-Timingだけを付ける"""
+    app.config['SQL_INSTRUMENTATION'] = True
+    with app.app_context():
+        get_pool().close()
+
+    for path in ('/search?q=test', '/1'):
+        first = client.get(path)
+        assert len(first.headers.getlist('Server-Timing')) == 1
+        cached = client.get(path)
+        assert cached.data == first.data
+        assert len(cached.headers.getlist('Server-Timing')) == 1
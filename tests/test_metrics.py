@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+from flask import Flask, testing
+
+from flaskr import create_app
+from flaskr.metrics import Registry, render
+
+
+@pytest.fixture
+def config():
+    return {'METRICS_ENABLED': True}
+
+
+def test_metrics(client: testing.FlaskClient):
+    """/metricsでエンドポイントごとのリクエスト数・レスポンス時間とプール・キャッシュの統計を出す"""
+    client.get('/')
+    client.get('/')
+    client.get('/1')
+    client.get('/no/such/page')
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'flaskr_requests_total{endpoint="blog.index",method="GET",status="200"} 2' in text
+    assert 'flaskr_requests_total{endpoint="unmatched",method="GET",status="404"} 1' in text
+    assert 'flaskr_request_duration_seconds_bucket{endpoint="blog.index",le="+Inf"} 2' in text
+    assert 'flaskr_request_duration_seconds_count{endpoint="blog.article"} 1' in text
+    # 2回目の一覧はページのキャッシュから返している
+    assert 'flaskr_cache_hits_total{cache="response"} 1' in text
+    assert 'flaskr_db_connections_created_total ' in text
+    assert 'flaskr_db_connections_in_use 0' in text
+
+
+def test_histogram():
+    """バケットは累積で数え、境界の値はそのバケットに入る"""
+    registry = Registry(buckets=(0.1, 1.0))
+    registry.observe('blog.index', 'GET', 200, 0.1)
+    registry.observe('blog.index', 'GET', 200, 0.5)
+    registry.observe('blog.index', 'GET', 500, 2.0)
+
+    text = render([{'pid': os.getpid(), **registry.snapshot(), 'counters': {}, 'gauges': {}}],
+                  buckets=(0.1, 1.0))
+    assert 'flaskr_request_duration_seconds_bucket{endpoint="blog.index",le="0.1"} 1' in text
+    assert 'flaskr_request_duration_seconds_bucket{endpoint="blog.index",le="1.0"} 2' in text
+    assert 'flaskr_request_duration_seconds_bucket{endpoint="blog.index",le="+Inf"} 3' in text
+    assert 'flaskr_request_duration_seconds_sum{endpoint="blog.index"} 2.600000' in text
+    assert 'flaskr_request_errors_total{endpoint="blog.index"} 1' in text
+
+
+def test_multiple_processes(app: Flask, client: testing.FlaskClient, tmp_path):
+    """METRICS_DIRの他のプロセスの写しを合計し、終わったプロセスのゲージは数えない"""
+    app.config['METRICS_DIR'] = str(tmp_path)
+    other = {
+        'pid': 2 ** 22 + 1,  # 存在しないプロセス
+        'requests': [['blog.index', 'GET', 200, 5]],
+        'durations': {'blog.index': [5] + [0] * 11 + [0.01]},
+        'counters': {'db_connections_created': 3},
+        'gauges': {'db_connections_idle': 3},
+    }
+    (tmp_path / 'metrics-4194305.json').write_text(json.dumps(other))
+
+    client.get('/')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'flaskr_requests_total{endpoint="blog.index",method="GET",status="200"} 6' in text
+    assert 'flaskr_request_duration_seconds_count{endpoint="blog.index"} 6' in text
+    assert f'metrics-{os.getpid()}.json' in os.listdir(tmp_path)
+    assert 'flaskr_db_connections_idle 1' in text
+
+
+def test_disabled_by_default():
+    """/metricsは有効にしなければ登録しない"""
+    app = create_app({'TESTING': True, 'JINJA_BYTECODE_CACHE_DIR': None})
+    assert 'metrics' not in app.view_functions
+    assert app.test_client().get('/metrics').status_code == 404
+
+
+def test_access(app: Flask, client: testing.FlaskClient):
+    """トークンがなければ同じマシンからだけ、あればそのトークンのリクエストだけに返す"""
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '192.0.2.1'}).status_code == 404
+
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    res = client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                     environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    assert res.status_code == 200
@@ -0,0 +1,115 @@
+import os
+import subprocess
+import sys
+
+from flask import Flask, testing
+from jinja2 import FileSystemBytecodeCache
+
+from conftest import AuthAction
+
+from flaskr.db import get_db
+from flaskr.render import make_excerpt
+
+
+def test_make_excerpt():
+    """抜粋はmarkdownを取り除いた先頭30文字で、長ければ...が付く"""
+    assert make_excerpt('# hoge') == 'hoge'
+    assert make_excerpt('a < b') == 'a < b'
+    assert make_excerpt('*' + 'a' * 40) == '*' + 'a' * 29 + ' ...'
+
+
+def test_create_renders_once(app: Flask, client: testing.FlaskClient, auth: AuthAction):
+    """作成・更新時にHTMLと抜粋が保存され、表示ではそれが使われる"""
+    auth.login()
+    client.post('/create', data={'title': 'md', 'body': '# hello\n\n**world**'})
+    with app.app_context():
+        post = get_db().execute('SELECT * FROM post WHERE id = 2').fetchone()
+        assert post['body_html'] == '<h1>hello</h1>\n\n<p><strong>world</strong></p>\n'
+        assert post['excerpt'] == 'hello world'
+
+    client.post('/2/update', data={'title': 'md', 'body': '## bye'})
+    with app.app_context():
+        db = get_db()
+        post = db.execute('SELECT * FROM post WHERE id = 2').fetchone()
+        assert post['body_html'] == '<h2>bye</h2>\n'
+        assert post['excerpt'] == 'bye'
+
+        # 保存済みのHTMLで表示される
+        db.execute("UPDATE post SET body_html = '<p>stored</p>', excerpt = 'stored excerpt'")
+        db.commit()
+    assert b'<p>stored</p>' in client.get('/2').data
+    assert b'stored excerpt' in client.get('/').data
+
+
+def test_render_posts_command(app: Flask, runner: testing.FlaskCliRunner):
+    """render-postsコマンドで未変換の投稿をまとめて変換できる"""
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [('title', f'# body{i}') for i in range(4)]
+        )
+        db.commit()
+
+    result = runner.invoke(args=['render-posts', '--batch-size', '2'])
+    assert 'Rendered 2 posts...' in result.output
+    assert 'Rendered 5 posts in total.' in result.output
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute(
+            'SELECT count(*) FROM post WHERE body_html IS NULL').fetchone()[0] == 0
+        post = db.execute('SELECT * FROM post WHERE id = 5').fetchone()
+        assert post['body_html'] == '<h1>body3</h1>\n'
+        assert post['excerpt'] == 'body3'
+
+    # 変換済みの投稿は--allを付けたときだけ変換し直す
+    result = runner.invoke(args=['render-posts'])
+    assert 'Rendered 0 posts in total.' in result.output
+    result = runner.invoke(args=['render-posts', '--all'])
+    assert 'Rendered 5 posts in total.' in result.output
+
+    # 変換の結果が変わらない投稿の版数は変えず、変わった投稿だけ版数を上げる
+    with app.app_context():
+        db = get_db()
+        versions = dict(db.execute('SELECT id, version FROM post').fetchall())
+        db.execute("UPDATE post SET body_html = 'old' WHERE id = 5")
+        db.commit()
+    runner.invoke(args=['render-posts', '--all'])
+    with app.app_context():
+        db = get_db()
+        post = db.execute('SELECT * FROM post WHERE id = 5').fetchone()
+        assert post['body_html'] == '<h1>body3</h1>\n'
+        assert post['version'] == versions[5] + 1
+        assert post['updated'] is not None
+        assert db.execute('SELECT version FROM post WHERE id = 4').fetchone()[0] == versions[4]
+        generation = db.execute(
+            "SELECT generation FROM cache_generation WHERE namespace = 'post:5'").fetchone()
+        assert generation is not None
+
+
+def test_precompile_command(app: Flask, runner: testing.FlaskCliRunner, tmp_path):
+    """precompileコマンドですべてのテンプレートをバイトコードのキャッシュに入れる"""
+    assert isinstance(app.jinja_env.bytecode_cache, FileSystemBytecodeCache)
+    cache_dir = app.config['JINJA_BYTECODE_CACHE_DIR']
+    assert cache_dir.startswith(str(tmp_path))
+
+    result = runner.invoke(args=['precompile'])
+    count = len(app.jinja_env.list_templates())
+    assert f'Compiled {count} templates' in result.output
+    assert len(os.listdir(cache_dir)) == count
+
+
+def test_lazy_markdown_import():
+    """アプリケーションを作るだけならmarkdown2を読み込まない"""
+    code = (
+        'import sys, tempfile\n'
+        'from flaskr import create_app\n'
+        'app = create_app({"TESTING": True, "DATABASE": tempfile.mktemp(),'
+        ' "JINJA_BYTECODE_CACHE_DIR": None})\n'
+        'assert "markdown2" not in sys.modules\n'
+        'from flaskr.render import render_body\n'
+        'render_body("# a")\n'
+        'assert "markdown2" in sys.modules\n'
+    )
+    subprocess.run([sys.executable, '-c', code], check=True)
@@ -0,0 +1,84 @@
+from flask import Flask, testing
+
+from flaskr.db import get_db, rebuild_counters
+from flaskr.seed import seed
+
+
+def _snapshot(db):
+    return [tuple(row) for row in db.execute(
+        'SELECT p.id, p.author_id, p.title, p.agree, v.user_id, v.intention'
+        ' FROM post p JOIN vote v ON v.post_id = p.id ORDER BY p.id, v.user_id'
+    )]
+
+
+def test_seed_command(app: Flask, runner: testing.FlaskCliRunner):
+    """seedコマンドで合成データを投入でき、索引・トリガー・カウンタが正しく揃っている"""
+    result = runner.invoke(args=[
+        'seed', '--users', '20', '--posts', '25', '--batch-size', '10',
+    ])
+    assert 'Inserted 10/25 posts' in result.output
+    assert 'Seeded 20 users, 25 posts, 75 comments and 125 votes' in result.output
+
+    with app.app_context():
+        db = get_db()
+        # テストデータの後ろに追加されている
+        assert db.execute('SELECT count(*) FROM post').fetchone()[0] == 26
+        assert db.execute('SELECT count(*) FROM comment').fetchone()[0] == 76
+        assert db.execute('SELECT title FROM post WHERE id = 1').fetchone()[0] == 'test title'
+        # 投稿の行に入れたカウンタは実際の件数と一致している
+        assert rebuild_counters() == 0
+
+        # 外した索引とトリガーが作り直されている
+        objects = {row['name'] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger')")}
+        assert {'post_created_idx', 'comment_post_idx', 'comment_count_insert',
+                'post_fts_insert'} <= objects
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert db.execute('PRAGMA temp_store').fetchone()[0] == 0
+
+        # 全文検索の索引も作られている
+        assert db.execute(
+            "SELECT count(*) FROM post_fts WHERE post_fts MATCH 'flask'").fetchone()[0] > 0
+
+
+def test_seed_is_deterministic(app: Flask):
+    """同じシードなら同じデータになる"""
+    snapshots = []
+    for _ in range(2):
+        with app.app_context():
+            db = get_db()
+            db.execute('DELETE FROM vote')
+            db.execute('DELETE FROM comment')
+            db.execute('DELETE FROM post')
+            db.execute('DELETE FROM user')
+            db.commit()
+            list(seed(10, 15, seed=42, batch_size=4))
+            snapshots.append(_snapshot(db))
+
+    assert snapshots[0] == snapshots[1]
+    assert len(snapshots[0]) == 15 * 5
+
+
+def test_seed_interrupted(app: Flask):
+    """途中で止めても索引・トリガーは作り直され、カウンタ・全文検索の索引は更新され続ける"""
+    with app.app_context():
+        db = get_db()
+        names = "SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name"
+        objects = db.execute(names).fetchall()
+
+        progress = seed(10, 25, batch_size=10)
+        assert next(progress) == 10
+        # ^C などで投入が止まったことにする
+        progress.close()
+
+        assert db.execute(names).fetchall() == objects
+        assert db.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+        assert db.execute('PRAGMA temp_store').fetchone()[0] == 0
+        # 止まる前にコミットしたバッチは残り、全文検索の索引にも入っている
+        assert db.execute('SELECT count(*) FROM post').fetchone()[0] == 11
+        db.execute("INSERT INTO post_fts (post_fts) VALUES ('integrity-check')")
+        assert rebuild_counters() == 0
+
+        db.execute("INSERT INTO comment (post_id, commenter_id, body) VALUES (2, 1, 'after')")
+        db.commit()
+        assert db.execute('SELECT comment_count FROM post WHERE id = 2').fetchone()[0] == 4
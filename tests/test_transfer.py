@@ -0,0 +1,72 @@
+import gzip
+import json
+
+from flask import Flask, testing
+
+from flaskr.db import get_db, init_db
+
+
+def _dump(db):
+    return {
+        table: [tuple(row) for row in db.execute(f'SELECT * FROM "{table}" ORDER BY 1, 2')]
+        for table in ('user', 'post', 'comment', 'vote')
+    }
+
+
+def test_export_import(app: Flask, runner: testing.FlaskCliRunner, tmp_path):
+    """書き出したデータを空のデータベースに読み込むと同じ内容になる（gzipも使える）"""
+    with app.app_context():
+        get_db().execute('INSERT INTO vote (post_id, user_id, intention) VALUES (1, 2, 1)')
+        get_db().commit()
+        before = _dump(get_db())
+
+    path = tmp_path / 'data.ndjson.gz'
+    result = runner.invoke(args=['export', str(path)])
+    assert 'Exported 2 user, 1 post, 1 comment, 1 vote.' in result.output
+
+    lines = [json.loads(line) for line in gzip.open(path)]
+    assert lines[0] == {'table': 'user', 'row': {'id': 1, 'username': 'test', 'password': lines[0]['row']['password']}}
+    # 日時は保存されている文字列のまま
+    assert [line['row']['created'] for line in lines if line['table'] == 'post'] == ['2018-01-01 00:00:00']
+
+    with app.app_context():
+        init_db()
+    result = runner.invoke(args=['import', str(path), '--batch-size', '2'])
+    assert 'Imported 2 user, 1 post, 1 comment, 1 vote.' in result.output
+
+    with app.app_context():
+        db = get_db()
+        # カウンタは二重に数えられておらず、トリガーも戻っている
+        assert _dump(db) == before
+        triggers = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        assert {'comment_count_insert', 'vote_count_insert'} <= triggers
+        assert db.execute("SELECT rowid FROM post_fts WHERE post_fts MATCH 'test'").fetchone()[0] == 1
+
+
+def test_import_resume(app: Flask, runner: testing.FlaskCliRunner, tmp_path):
+    """途中で止まった読み込みは--resumeで各表の最後のキーの続きから再開できる"""
+    path = tmp_path / 'data.ndjson'
+    runner.invoke(args=['export', str(path)])
+    with app.app_context():
+        before = _dump(get_db())
+        init_db()
+
+    # 投稿まで読み込んだところで止まったことにする
+    partial = tmp_path / 'partial.ndjson'
+    partial.write_text(''.join(path.read_text().splitlines(keepends=True)[:3]))
+    runner.invoke(args=['import', str(partial)])
+
+    result = runner.invoke(args=['import', str(path)])
+    assert 'Import failed: UNIQUE constraint failed' in result.output
+
+    result = runner.invoke(args=['import', str(path), '--resume'])
+    assert 'Imported 0 user, 0 post, 1 comment, 0 vote.' in result.output
+    with app.app_context():
+        assert _dump(get_db()) == before
+
+
+def test_import_rejects_unknown(app: Flask, runner: testing.FlaskCliRunner, tmp_path):
+    path = tmp_path / 'bad.ndjson'
+    path.write_text(json.dumps({'table': 'post', 'row': {'id': 5, 'title; DROP': 'x'}}) + '\n')
+    result = runner.invoke(args=['import', str(path)])
+    assert 'unknown columns' in result.output